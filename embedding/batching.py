@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def plan_batches(lengths, token_budget=16384, max_batch_size=256):
+    # Packs items into batches of similar sequence length: items are sorted by length, and each batch
+    # is filled as long as its padded size (number of items times the longest length) stays within the
+    # token budget. Returns a list of arrays of item indices.
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='stable')
+    batches = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        if end == len(order) or end - start >= max_batch_size \
+                or (end - start + 1) * lengths[order[end]] > token_budget:
+            batches.append(order[start:end])
+            start = end
+    return batches
+
+
+class PaddingStats:
+
+    def __init__(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.batches = 0
+
+    def add(self, lengths):
+        self.real_tokens += int(np.sum(lengths))
+        self.padded_tokens += len(lengths) * int(np.max(lengths))
+        self.batches += 1
+
+    @property
+    def padding_ratio(self):
+        return 1 - self.real_tokens / self.padded_tokens if self.padded_tokens > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.batches} batches, {self.real_tokens} tokens, {self.padded_tokens} with padding " \
+               f"(padding ratio {self.padding_ratio:.1%})"
+
+
+class DedupStats:
+
+    def __init__(self):
+        self.contexts = 0
+        self.forward_passes = 0
+
+    def add(self, num_contexts, num_forward_passes):
+        self.contexts += num_contexts
+        self.forward_passes += num_forward_passes
+
+    @property
+    def dedup_ratio(self):
+        return 1 - self.forward_passes / self.contexts if self.contexts > 0 else 0.0
+
+    def __str__(self):
+        return f"{self.contexts} contexts, {self.forward_passes} forward passes " \
+               f"(deduplicated {self.dedup_ratio:.1%})"
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas
+import torch
+import transformers
+from transformers import BertConfig, BertModel, BertTokenizer
+
+from embedding_output import word2vec_files
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def synthetic_wordpieces(num_pieces, rng):
+    # distinct random strings, including all single letters (so that every lowercase word can be tokenized)
+    pieces = set(LETTERS)
+    while len(pieces) < num_pieces:
+        pieces.add(''.join(rng.choice(list(LETTERS), size=rng.integers(2, 6))))
+    return sorted(pieces)
+
+
+def synthetic_words(num_words, pieces, rng):
+    # distinct words of one to three pieces
+    words = set()
+    while len(words) < num_words:
+        words.add(''.join(rng.choice(pieces, size=rng.integers(1, 4))))
+    return sorted(words)
+
+
+def build_model(directory, pieces, hidden_size, num_layers, num_heads, seed):
+    # saves a tokenizer over the given pieces (and their ## suffix forms), and a randomly initialized BERT model
+    vocab_path = os.path.join(directory, 'vocab.txt')
+    with open(vocab_path, 'w', encoding='utf8') as f:
+        for piece in SPECIAL_TOKENS + pieces + ['##' + piece for piece in pieces]:
+            print(piece, file=f)
+    tokenizer = BertTokenizer(vocab_path, do_lower_case=False)
+    tokenizer.save_pretrained(directory)
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(tokenizer.vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=num_heads, intermediate_size=4 * hidden_size)
+    BertModel(config).save_pretrained(directory)
+    return tokenizer
+
+
+def write_corpus(directory, tokenizer, words, num_lines, max_line_len, zipf_exponent, rng):
+    # writes a processed corpus (one line of wordpieces per sentence) with Zipf-distributed word frequencies, and
+    # its vocabulary file; returns the word counts (most frequent first) and the number of wordpieces
+    word_pieces = [tokenizer.wordpiece_tokenizer.tokenize(word) for word in words]
+    probs = 1 / np.arange(1, len(words) + 1) ** zipf_exponent
+    probs /= probs.sum()
+    counts = np.zeros(len(words), dtype=np.int64)
+    num_pieces = 0
+    with open(os.path.join(directory, 'corpus.txt'), 'w', encoding='utf8') as f:
+        for _ in range(num_lines):
+            line = rng.choice(len(words), size=rng.integers(3, max_line_len + 1), p=probs)
+            np.add.at(counts, line, 1)
+            pieces = [piece for w in line for piece in word_pieces[w]]
+            num_pieces += len(pieces)
+            print(*pieces, file=f)
+
+    order = np.argsort(-counts, kind='stable')
+    word_counts = [(words[i], int(counts[i])) for i in order if counts[i] > 0]
+    with open(os.path.join(directory, 'vocab_counts.txt'), 'w', encoding='utf8') as f:
+        for word, count in word_counts:
+            print(word, count, file=f)
+    return word_counts, num_pieces
+
+
+def write_query_words(directory, word_counts, num_query_words, min_count):
+    # query words spread evenly over the frequency ranks of the words occurring at least min_count times
+    candidates = [word for word, count in word_counts if count >= min_count]
+    positions = np.linspace(0, len(candidates) - 1, min(num_query_words, len(candidates))).round().astype(int)
+    query_words = [candidates[i] for i in positions]
+    with open(os.path.join(directory, 'query_words.txt'), 'w', encoding='utf8') as f:
+        for word in query_words:
+            print(word, file=f)
+    return query_words
+
+
+def write_testsets(directory, words, size, rng):
+    # a testsets file (cf. generate_testsets.py) of random entries over the given words, for every dataset
+    rows = []
+    for dataset in ['men', 'simlex', 'schm280']:
+        for _ in range(size):
+            left, right = rng.choice(words, size=2, replace=False)
+            rows.append({'dataset': dataset, '0': left, '1': right, 'value': round(float(rng.uniform(0, 10)), 2)})
+    for dataset in ['toefl', 'duden']:
+        for _ in range(size):
+            prompt = rng.choice(words, size=5, replace=False)
+            rows.append(dict(dataset=dataset, **{str(i): word for i, word in enumerate(prompt)}))
+    for dataset in ['wiktionary', 'germanet']:
+        for _ in range(size):
+            left, right = rng.choice(words, size=2, replace=False)
+            rows.append({'dataset': dataset, '0': left, '1': right, 'value': f"relation{rng.integers(4)}"})
+    testsets = pandas.DataFrame(rows, columns=['dataset', '0', '1', '2', '3', '4', '5', 'value'])
+    testsets.to_csv(os.path.join(directory, 'testsets.tsv'), sep='\t', index=False)
+    return len(testsets)
+
+
+def run_stage(script, arguments, env, log_path):
+    # runs a script of this directory, with its stderr written to log_path; returns the return code, the wall time
+    # and the peak RSS (in MiB) of the process
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, script)] + arguments,
+                                   stdout=subprocess.DEVNULL, stderr=log, env=env, cwd=SCRIPT_DIR)
+        _, status, rusage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    # (negative for a signal, as Popen.returncode; ru_maxrss is in KiB on Linux, the largest of the process and its
+    # own children, e.g. the workers of embedder.py --workers)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return process.returncode, seconds, rusage.ru_maxrss / 1024
+
+
+def parse_padding_stats(log_path):
+    # the token counts of the PaddingStats and DedupStats printed by the embedder, summed over all of them (with
+    # --workers, every shard prints its own)
+    with open(log_path, 'r', encoding='utf8', errors='replace') as f:
+        log = f.read()
+    padding = [tuple(map(int, match)) for match in re.findall(r"(\d+) batches, (\d+) tokens, (\d+) with padding", log)]
+    dedup = [tuple(map(int, match)) for match in re.findall(r"(\d+) contexts, (\d+) forward passes", log)]
+    stats = dict()
+    if padding:
+        batches, real_tokens, padded_tokens = map(sum, zip(*padding))
+        stats.update(batches=batches, model_tokens=real_tokens, padded_tokens=padded_tokens,
+                     padding_ratio=1 - real_tokens / padded_tokens if padded_tokens > 0 else 0.0)
+    if dedup:
+        contexts, forward_passes = map(sum, zip(*dedup))
+        stats.update(forward_passes=forward_passes, dedup_ratio=1 - forward_passes / contexts if contexts > 0 else 0.0)
+    return stats
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks contexts.py, embedder.py and evaluation.py offline, on a synthetic corpus and a small '
+                    'randomly initialized BERT model, and saves wall time, peak RSS and throughput of every stage '
+                    'as JSON')
+    parser.add_argument('--output', type=str, required=True, help='JSON file to write the results to')
+    parser.add_argument('--work-dir', dest='work_dir', type=str,
+                        help='Directory for the generated data and the outputs of the stages (kept); defaults to a '
+                             'temporary directory')
+    parser.add_argument('--stages', type=str, default='contexts,embedder,evaluation',
+                        help='Comma-separated list of the stages to run (each requires the previous ones)')
+    parser.add_argument('--lines', type=int, default=20000, help='Number of lines of the synthetic corpus')
+    parser.add_argument('--max-line-len', dest='max_line_len', type=int, default=60,
+                        help='Maximum number of words per line')
+    parser.add_argument('--words', type=int, default=20000, help='Number of distinct words of the synthetic corpus')
+    parser.add_argument('--wordpieces', type=int, default=2000,
+                        help='Number of wordpieces (without ## suffix forms) of the synthetic vocabulary')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the Zipf distribution of the words')
+    parser.add_argument('--query-words', dest='query_words', type=int, default=200,
+                        help='Number of query words to sample contexts for')
+    parser.add_argument('--count', type=int, default=50, help='Number of contexts to sample per query word')
+    parser.add_argument('--testset-size', dest='testset_size', type=int, default=100,
+                        help='Number of entries per dataset of the synthetic testsets')
+    parser.add_argument('--hidden-size', dest='hidden_size', type=int, default=64, help='Hidden size of the model')
+    parser.add_argument('--layers', type=int, default=12, help='Number of transformer layers of the model')
+    parser.add_argument('--heads', type=int, default=4, help='Number of attention heads of the model')
+    parser.add_argument('--contexts-args', dest='contexts_args', type=str, default='',
+                        help='Further arguments to contexts.py, e.g. "--workers 4"')
+    parser.add_argument('--embedder-args', dest='embedder_args', type=str,
+                        default='--vectorizations layer12,layer9to12 --poolings mean,first,l2medoid '
+                                '--aggregations mean,median',
+                        help='Further arguments to embedder.py, e.g. the variants to generate, or "--device cpu '
+                             '--threads 4"')
+    parser.add_argument('--seed', type=int, default=15452, help='Random seed')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+    stages = args.stages.split(',')
+    # (absolute, as the stages run in the directory of the scripts)
+    work_dir = os.path.abspath(args.work_dir if args.work_dir is not None else
+                               tempfile.mkdtemp(prefix='embedding_benchmark_'))
+    os.makedirs(work_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+
+    print(f"generating the synthetic data in {work_dir}", file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    model_dir = os.path.join(work_dir, 'model')
+    os.makedirs(model_dir, exist_ok=True)
+    pieces = synthetic_wordpieces(args.wordpieces, rng)
+    tokenizer = build_model(model_dir, pieces, args.hidden_size, args.layers, args.heads, args.seed)
+    words = synthetic_words(args.words, pieces, rng)
+    word_counts, corpus_tokens = write_corpus(work_dir, tokenizer, words, args.lines, args.max_line_len, args.zipf,
+                                              rng)
+    query_words = write_query_words(work_dir, word_counts, args.query_words, min_count=args.count)
+    generate_seconds = time.perf_counter() - start
+
+    results = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+               'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                               'cpus': os.cpu_count(), 'torch': torch.__version__,
+                               'transformers': transformers.__version__},
+               'settings': vars(args),
+               'data': {'corpus_lines': args.lines, 'corpus_tokens': corpus_tokens, 'words': len(word_counts),
+                        'query_words': len(query_words), 'generate_seconds': generate_seconds},
+               'stages': dict()}
+    env = dict(os.environ, EMBEDDING_MODEL=model_dir, TRANSFORMERS_OFFLINE='1', HF_HUB_OFFLINE='1')
+    contexts_path = os.path.join(work_dir, 'contexts.tsv')
+    output_prefix = os.path.join(work_dir, 'embeddings', 'embeddings_')
+    failed = False
+
+    for stage in stages:
+        log_path = os.path.join(work_dir, stage + '.log')
+        print(f"running {stage}", file=sys.stderr, flush=True)
+        if stage == 'contexts':
+            arguments = ['--query-words', os.path.join(work_dir, 'query_words.txt'), '--output', contexts_path,
+                         '--vocab', os.path.join(work_dir, 'vocab_counts.txt'),
+                         '--corpus', os.path.join(work_dir, 'corpus.txt'), '--count', str(args.count),
+                         '--seed', str(args.seed)] + shlex.split(args.contexts_args)
+            returncode, seconds, peak_rss = run_stage('contexts.py', arguments, env, log_path)
+            # contexts/s counts the sampled contexts, tokens/s the scanned corpus wordpieces
+            num_contexts = len(pandas.read_csv(contexts_path, sep='\t', usecols=['token'])) if returncode == 0 else 0
+            stats = {'contexts': num_contexts, 'contexts_per_second': num_contexts / seconds,
+                     'tokens': corpus_tokens, 'tokens_per_second': corpus_tokens / seconds}
+        elif stage == 'embedder':
+            os.makedirs(os.path.dirname(output_prefix), exist_ok=True)
+            arguments = ['--contexts', contexts_path, '--output-prefix', output_prefix] + \
+                        shlex.split(args.embedder_args)
+            returncode, seconds, peak_rss = run_stage('embedder.py', arguments, env, log_path)
+            # tokens/s counts the (non-padding) tokens passed through the model
+            context_lens = pandas.read_csv(contexts_path, sep='\t', usecols=['context_len'])['context_len']
+            stats = {'contexts': len(context_lens), 'contexts_per_second': len(context_lens) / seconds}
+            stats.update(parse_padding_stats(log_path))
+            if 'model_tokens' in stats:
+                stats['tokens_per_second'] = stats['model_tokens'] / seconds
+        elif stage == 'evaluation':
+            num_entries = write_testsets(work_dir, query_words, args.testset_size, rng)
+            embedding_files = list(word2vec_files(output_prefix).values())
+            arguments = ['--testsets', os.path.join(work_dir, 'testsets.tsv'),
+                         '--output', os.path.join(work_dir, 'evaluation.tsv')] + embedding_files
+            returncode, seconds, peak_rss = run_stage('evaluation.py', arguments, env, log_path)
+            stats = {'embeddings': len(embedding_files), 'entries': num_entries,
+                     'entries_per_second': len(embedding_files) * num_entries / seconds}
+        else:
+            parser.error(f"unknown stage {stage}")
+
+        results['stages'][stage] = dict(returncode=returncode, wall_seconds=seconds, peak_rss_mib=peak_rss, **stats)
+        print(stage, json.dumps(results['stages'][stage]), file=sys.stderr, flush=True)
+        if returncode != 0:
+            print(f"{stage} failed, see {log_path}", file=sys.stderr)
+            failed = True
+            break
+
+    with open(args.output, 'w', encoding='utf8') as f:
+        json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
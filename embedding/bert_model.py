@@ -0,0 +1,12 @@
+import os
+
+import torch
+
+# the BERT model (a name on the Hugging Face hub, or a local directory) of all scripts; the EMBEDDING_MODEL
+# environment variable overrides it, e.g. for a small local model (cf. benchmark.py)
+MODEL_NAME = os.environ.get('EMBEDDING_MODEL', 'deepset/gbert-base')
+
+
+def torch_version():
+    # the (major, minor) version of the installed torch
+    return tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2])
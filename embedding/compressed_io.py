@@ -0,0 +1,197 @@
+import bz2
+import gzip
+import io
+import os
+import queue
+import threading
+
+from tqdm import tqdm
+
+from shards import range_line_iter
+
+MAGIC_BYTES = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+SUFFIXES = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.zst': 'zstd',
+}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('reading or writing zstd-compressed files requires the zstandard package '
+                          '(pip install zstandard)')
+    return zstandard
+
+
+def _decompressing_reader(method, f):
+    if method == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    if method == 'bz2':
+        return bz2.BZ2File(f, mode='rb')
+    return _zstandard().ZstdDecompressor().stream_reader(f, read_across_frames=True)
+
+
+def _compressing_writer(method, f):
+    if method == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6)
+    if method == 'bz2':
+        return bz2.BZ2File(f, mode='wb')
+    return _zstandard().ZstdCompressor().stream_writer(f)
+
+
+def detect_compression(f):
+    head = f.peek(4)[:4] if hasattr(f, 'peek') else b''
+    for magic, method in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return method
+    return None
+
+
+class ThreadedDecompressor(io.RawIOBase):
+    # Decompresses a file in a background thread, which keeps a bounded queue of decompressed chunks
+    # filled (zlib, bz2 and zstd release the GIL while decompressing). compressed_position is the number
+    # of compressed bytes consumed so far, for progress reporting.
+
+    def __init__(self, compressed_file, method, chunk_size=1 << 20, queue_size=16):
+        super().__init__()
+        self.name = compressed_file.name
+        self.compressed_file = compressed_file
+        self.compressed_size = os.fstat(compressed_file.fileno()).st_size
+        self.compressed_position = 0
+        self._chunks = queue.Queue(queue_size)
+        self._pending = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._decompress, args=(method, chunk_size), daemon=True)
+        self._thread.start()
+
+    def _decompress(self, method, chunk_size):
+        try:
+            reader = _decompressing_reader(method, self.compressed_file)
+            while True:
+                chunk = reader.read(chunk_size)
+                self.compressed_position = self.compressed_file.tell()
+                if not chunk:
+                    break
+                self._chunks.put(chunk)
+            self._chunks.put(None)
+        except Exception as e:
+            self._chunks.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._pending) == 0:
+            if self._eof:
+                return 0
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self._eof = True
+                return 0
+            self._pending = memoryview(chunk)
+
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        self.compressed_file.close()
+        super().close()
+
+
+class ThreadedCompressor(io.RawIOBase):
+    # Compresses everything written to it in a background thread, fed through a bounded queue.
+
+    def __init__(self, path, method, queue_size=16):
+        super().__init__()
+        self.name = path
+        self._chunks = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._compress, args=(path, method), daemon=True)
+        self._thread.start()
+
+    def _compress(self, path, method):
+        try:
+            with open(path, 'wb') as f:
+                writer = _compressing_writer(method, f)
+                while True:
+                    chunk = self._chunks.get()
+                    if chunk is None:
+                        break
+                    writer.write(chunk)
+                writer.close()
+        except Exception as e:
+            self._error = e
+            # keep consuming, so that writers do not block on a full queue
+            while self._chunks.get() is not None:
+                pass
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._error is not None:
+            raise self._error
+        self._chunks.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._chunks.put(None)
+            self._thread.join()
+        super().close()
+        if self._error is not None:
+            raise self._error
+
+
+def open_input(f):
+    # Returns the given binary file if it is uncompressed, or a buffered stream of its decompressed
+    # contents if it is gzip-, bz2- or zstd-compressed (detected by its magic bytes).
+    method = detect_compression(f)
+    if method is None:
+        return f
+    return io.BufferedReader(ThreadedDecompressor(f, method), buffer_size=1 << 20)
+
+
+def is_compressed(f):
+    return isinstance(getattr(f, 'raw', None), ThreadedDecompressor)
+
+
+def open_output(f):
+    # Returns the given text file, or, if its name ends with .gz, .bz2 or .zst, a text stream on the
+    # same path which is compressed accordingly in a background thread.
+    method = SUFFIXES.get(os.path.splitext(f.name)[1])
+    if method is None:
+        return f
+    f.close()
+    return io.TextIOWrapper(io.BufferedWriter(ThreadedCompressor(f.name, method), buffer_size=1 << 20),
+                            encoding='utf-8')
+
+
+def progress_line_iter(f, start=0, end=None, position=None, update_every=1000, **tqdm_args):
+    # Iterates over the raw lines of f, showing the progress in bytes. For compressed files, the progress
+    # is measured in compressed bytes; uncompressed files may be restricted to the byte range [start, end).
+    if is_compressed(f):
+        assert start == 0 and end is None, 'compressed files cannot be read partially'
+        with tqdm(unit='B', unit_scale=True, total=f.raw.compressed_size, position=position, **tqdm_args) as pbar:
+            for i, line in enumerate(f):
+                if i % update_every == 0:
+                    pbar.update(f.raw.compressed_position - pbar.n)
+                yield line
+            pbar.update(f.raw.compressed_position - pbar.n)
+    else:
+        end = os.path.getsize(f.name) if end is None else end
+        with tqdm(unit='B', unit_scale=True, total=end - start, position=position, **tqdm_args) as pbar:
+            for line in range_line_iter(f, start, end):
+                pbar.update(len(line))
+                yield line
@@ -0,0 +1,60 @@
+import array
+import os
+
+import pandas
+from tqdm import tqdm
+
+INTEGER_COLUMNS = ('counter', 'context_len', 'focus_index', 'focus_len', 'line')
+
+
+class ContextReader:
+    # Reads a contexts file (as generated from contexts.py) word by word, without loading it as a whole.
+    # A first pass indexes the byte offsets of the lines of each focus word; the contexts of a word are
+    # then read by seeking to them, so memory is bounded by the largest word rather than the file size.
+
+    def __init__(self, contexts_file, usecols=None):
+        self.file = contexts_file
+        header = contexts_file.readline()
+        self.columns = header.decode('utf-8').rstrip('\r\n').split('\t')
+        self.usecols = self.columns if usecols is None else [c for c in self.columns if c in usecols]
+        self.offsets = dict()
+
+        offset = len(header)
+        with tqdm(unit='B', unit_scale=True, total=os.path.getsize(contexts_file.name), initial=offset,
+                  desc='indexing contexts') as pbar:
+            for line in contexts_file:
+                token = line[:line.index(b'\t')].decode('utf-8')
+                if token not in self.offsets:
+                    self.offsets[token] = array.array('Q')
+                self.offsets[token].append(offset)
+                offset += len(line)
+                pbar.update(len(line))
+
+    def __len__(self):
+        return sum(len(offsets) for offsets in self.offsets.values())
+
+    def count(self, token):
+        return len(self.offsets.get(token, ()))
+
+    def read(self, token):
+        # the contexts of the given focus word, as a DataFrame of the (selected) columns
+        rows = []
+        for offset in self.offsets[token]:
+            self.file.seek(offset)
+            rows.append(self.file.readline().decode('utf-8').rstrip('\r\n').split('\t'))
+        contexts = pandas.DataFrame(rows, columns=self.columns)[self.usecols]
+        for column in INTEGER_COLUMNS:
+            if column in contexts:
+                contexts[column] = contexts[column].astype(int)
+        return contexts
+
+    def words(self):
+        # the focus words, in the order they are yielded by groups
+        return sorted(self.offsets)
+
+    def groups(self, words=None, skip=()):
+        # yields (focus word, contexts) for the given words (by default, all focus words in sorted order),
+        # leaving out the words in skip
+        for token in self.words() if words is None else words:
+            if token not in skip:
+                yield token, self.read(token)
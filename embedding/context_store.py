@@ -0,0 +1,108 @@
+import json
+import os
+
+import numpy as np
+
+
+class ContextStoreWriter:
+    # Stores the context embeddings (contexts x subwords x layers x hidden size) of every focus word, so that
+    # type embeddings can be generated again without the model. The arrays are appended to chunk files of
+    # about chunk_size bytes (PREFIX.chunk0, ...); PREFIX.index lists the word, chunk, offset (in elements)
+    # and shape of every entry, and PREFIX.meta the layers and dtype. With resume_words, the store of a
+    # previous, interrupted run is cut back to these words and continued.
+
+    def __init__(self, prefix, layers, hidden_size, fp16=False, chunk_size=1 << 30, resume_words=None):
+        self.prefix = prefix
+        self.dtype = np.dtype('<f2' if fp16 else '<f4')
+        self.chunk_size = chunk_size
+        self.meta = {'layers': list(layers), 'hidden_size': hidden_size, 'dtype': self.dtype.str}
+        self.chunk = 0
+        self.offset = 0
+
+        if resume_words:
+            with open(prefix + '.meta', 'r', encoding='utf8') as f:
+                if json.load(f) != self.meta:
+                    raise ValueError(f"{prefix}.meta does not match the layers and dtype of this run")
+            entries = read_index(prefix + '.index')[:len(resume_words)]
+            if [entry[0] for entry in entries] != list(resume_words):
+                raise ValueError(f"{prefix}.index does not match the journal")
+            _, self.chunk, offset, num_contexts, num_subwords = entries[-1]
+            self.offset = offset + num_contexts * num_subwords * len(layers) * hidden_size
+            # drop everything written after the last journaled word
+            with open(prefix + '.index', 'r+', encoding='utf8') as f:
+                f.truncate(sum(len('\t'.join(map(str, entry)).encode('utf8')) + 1 for entry in entries))
+            os.truncate(self._chunk_path(self.chunk), self.offset * self.dtype.itemsize)
+            chunk = self.chunk + 1
+            while os.path.exists(self._chunk_path(chunk)):
+                os.remove(self._chunk_path(chunk))
+                chunk += 1
+            self.index_file = open(prefix + '.index', 'a', encoding='utf8')
+            self.chunk_file = open(self._chunk_path(self.chunk), 'ab')
+        else:
+            with open(prefix + '.meta', 'w', encoding='utf8') as f:
+                json.dump(self.meta, f)
+            self.index_file = open(prefix + '.index', 'w', encoding='utf8')
+            self.chunk_file = open(self._chunk_path(self.chunk), 'wb')
+
+    def _chunk_path(self, chunk):
+        return f"{self.prefix}.chunk{chunk}"
+
+    def write(self, focus_word, context_embeddings):
+        if self.offset > 0 and (self.offset + context_embeddings.size) * self.dtype.itemsize > self.chunk_size:
+            self.chunk_file.close()
+            self.chunk += 1
+            self.offset = 0
+            self.chunk_file = open(self._chunk_path(self.chunk), 'wb')
+        self.chunk_file.write(np.ascontiguousarray(context_embeddings, dtype=self.dtype).tobytes())
+        num_contexts, num_subwords, _, _ = context_embeddings.shape
+        print(focus_word, self.chunk, self.offset, num_contexts, num_subwords, sep='\t', file=self.index_file)
+        self.offset += context_embeddings.size
+
+    def write_words(self, words):
+        # writes the context embeddings of several (focus_word, context_embeddings), and syncs them to disk
+        for focus_word, context_embeddings in words:
+            self.write(focus_word, context_embeddings)
+        for f in [self.chunk_file, self.index_file]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.chunk_file.close()
+        self.index_file.close()
+
+
+def read_index(path):
+    entries = []
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                # interrupted while writing
+                break
+            word, chunk, offset, num_contexts, num_subwords = line.rstrip('\n').split('\t')
+            entries.append((word, int(chunk), int(offset), int(num_contexts), int(num_subwords)))
+    return entries
+
+
+class ContextStore:
+    # read access to a context store, with the chunk files memory-mapped
+
+    def __init__(self, prefix):
+        with open(prefix + '.meta', 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        self.layers = meta['layers']
+        self.hidden_size = meta['hidden_size']
+        self.dtype = np.dtype(meta['dtype'])
+        self.entries = {entry[0]: entry[1:] for entry in read_index(prefix + '.index')}
+        self.words = list(self.entries)
+        self.chunks = dict()
+        for chunk in sorted({chunk for chunk, _, _, _ in self.entries.values()}):
+            self.chunks[chunk] = np.memmap(f"{prefix}.chunk{chunk}", dtype=self.dtype, mode='r')
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, word):
+        # the context embeddings of a word (contexts x subwords x layers x hidden size), memory-mapped
+        chunk, offset, num_contexts, num_subwords = self.entries[word]
+        shape = (num_contexts, num_subwords, len(self.layers), self.hidden_size)
+        return self.chunks[chunk][offset:offset + int(np.prod(shape))].reshape(shape)
@@ -1,92 +1,218 @@
 import argparse
-import collections
+import itertools
+import multiprocessing
 import os
 import random
 import sys
-from dataclasses import dataclass
-from typing import Union
 
+import numpy as np
 from tqdm import tqdm
 from transformers import BertTokenizer
 
+from bert_model import MODEL_NAME
+from compressed_io import is_compressed, open_input, open_output, progress_line_iter
+from occurrence_index import OccurrenceIndex, corpus_meta, read_lines, sample_occurrences
+from shards import line_aligned_ranges
+from token_corpus import TokenCorpus
+from wordpiece_cache import CachedWordpieceTokenizer
+from wordpiece_trie import WordpieceTrie
 
-def line_iter(corpus_file):
-    with tqdm(unit='B', unit_scale=True, total=os.path.getsize(corpus_file.name)) as pbar:
-        for line in corpus_file:
-            pbar.update(len(line))
-            yield line.decode('utf-8').strip().split()
 
+def line_iter(corpus_file, start=0, end=None, position=None):
+    for line in progress_line_iter(corpus_file, start, end, position=position):
+        yield line.decode('utf-8').strip().split()
 
-@dataclass
-class TrieNode:
-    value: Union[str, None]
-    children: dict
 
+def ids_line_iter(corpus, start=0, end=None, position=None):
+    end = len(corpus) if end is None else end
+    for line in tqdm(corpus.lines(start, end), total=end - start, unit='lines', unit_scale=True, position=position):
+        yield line
 
-BERT_TOKENIZER = BertTokenizer.from_pretrained("deepset/gbert-base")
+
+BERT_TOKENIZER = BertTokenizer.from_pretrained(MODEL_NAME)
 SUFFIXES = set(p for p in BERT_TOKENIZER.wordpiece_tokenizer.vocab if p.startswith('##'))
+SUFFIX_MASK = np.zeros(len(BERT_TOKENIZER.vocab), dtype=bool)
+SUFFIX_MASK[[BERT_TOKENIZER.vocab[p] for p in SUFFIXES]] = True
+WORDPIECES = CachedWordpieceTokenizer(BERT_TOKENIZER.wordpiece_tokenizer)
 
 
 def build_query_word_trie(query_words):
-    _trie = lambda: TrieNode(value=None, children=collections.defaultdict(_trie))
-    trie = _trie()
-    for word in query_words:
-        cur = trie
-        for piece in BERT_TOKENIZER.wordpiece_tokenizer.tokenize(word):
-            cur = cur.children[piece]
-        cur.value = word
-
-    return trie
-
-
-def search_occurrences(trie, tokenized_line):
-    l = 0
-    index = 0
-    cur = trie
-    for i, piece in enumerate(tokenized_line):
-        if piece not in SUFFIXES:
-            if cur.value is not None:
-                yield cur.value, index, l
-
-            cur = trie.children[piece]
-            index, l = i, 1
-        else:
-            if piece in cur.children.keys():
-                cur = cur.children[piece]
-                l += 1
-            else:
-                cur = trie
+    query_words = list(query_words)
+    piece_ids = [BERT_TOKENIZER.convert_tokens_to_ids(list(WORDPIECES.tokenize(word))) for word in query_words]
+    return WordpieceTrie(query_words, piece_ids, SUFFIX_MASK)
+
+
+def line_ids(line, as_ids=False):
+    if as_ids:
+        return np.asarray(line, dtype=np.int64)
+    vocab, unk_id = BERT_TOKENIZER.vocab, BERT_TOKENIZER.unk_token_id
+    return np.fromiter((vocab.get(piece, unk_id) for piece in line), dtype=np.int64, count=len(line))
+
+
+def search_occurrences(trie, tokenized_line, as_ids=False):
+    yield from trie.match(line_ids(tokenized_line, as_ids))
+
 
-    if cur.value is not None:
-        yield cur.value, index, l
+def batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
 
 
-def generate_contexts(sample_probs, corpus_file):
+def match_batch(trie, lines, as_ids=False):
+    # matches a batch of lines at once, see WordpieceTrie.match_lines
+    ids = [line_ids(line, as_ids) for line in lines]
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(i) for i in ids], out=offsets[1:])
+    return trie.match_lines(np.concatenate(ids) if len(ids) > 0 else np.empty(0, dtype=np.int64), offsets)
+
+
+def generate_contexts(sample_probs, lines, as_ids=False, rng=random, batch_size=1000):
+    # lines are either lists of wordpieces, or arrays of token ids (from a binary corpus)
     query_words_token_trie = build_query_word_trie(sample_probs.keys())
 
-    for line in line_iter(corpus_file):
-        for token, focus_start, focus_len in search_occurrences(query_words_token_trie, line):
-            if sample_probs[token] < random.random():
+    line_no = 0
+    for batch in batches(lines, batch_size):
+        for i, word_id, focus_start, focus_len in zip(*match_batch(query_words_token_trie, batch, as_ids)):
+            token = query_words_token_trie.words[word_id]
+            if sample_probs[token] < rng.random():
                 continue
 
+            line = batch[i]
             assert len(line) <= 510
-            yield token, line, focus_start, focus_len
+            yield token, line_no + int(i), line, int(focus_start), int(focus_len)
+        line_no += len(batch)
+
+
+def format_context(context, as_ids=False):
+    if as_ids:
+        context = BERT_TOKENIZER.convert_ids_to_tokens(np.asarray(context).tolist())
+    return ' '.join(context)
+
+
+def shard_seed(seed, index):
+    # per-shard seeds are derived from the global seed, so that samples only depend on the number of workers
+    return f"{seed}-{index}"
+
+
+_worker_state = None
+
+
+def _init_worker(sample_probs, corpus_path, corpus_ids):
+    global _worker_state
+    corpus = TokenCorpus(corpus_ids) if corpus_ids is not None else None
+    _worker_state = sample_probs, corpus_path, corpus
+
+
+def sample_shard(shard):
+    # samples contexts from one shard into a temporary file, without the counter column and with line
+    # numbers relative to the shard start; returns the number of lines of the shard
+    index, start, end, output_path, seed = shard
+    sample_probs, corpus_path, corpus = _worker_state
+    num_lines = 0
+
+    def counted(lines):
+        nonlocal num_lines
+        for line in lines:
+            num_lines += 1
+            yield line
+
+    with open(output_path, 'w') as output:
+        if corpus is not None:
+            lines = ids_line_iter(corpus, start, end, position=index)
+        else:
+            corpus_file = open(corpus_path, 'rb')
+            lines = line_iter(corpus_file, start, end, position=index)
+        for token, line_no, context, focus_start, focus_len in generate_contexts(
+                sample_probs, counted(lines), as_ids=corpus is not None, rng=random.Random(seed)):
+            print(token, len(context), focus_start, focus_len, format_context(context, corpus is not None), line_no,
+                  file=output, sep='\t')
+        if corpus is None:
+            corpus_file.close()
+
+    return num_lines
+
+
+def sample_parallel(sample_probs, counter, num_workers, seed, output, corpus_path=None, corpus_ids=None):
+    if corpus_ids is not None:
+        num_lines = len(TokenCorpus(corpus_ids))
+        ranges = [(num_lines * i // num_workers, num_lines * (i + 1) // num_workers) for i in range(num_workers)]
+    else:
+        ranges = line_aligned_ranges(corpus_path, num_workers)
+    shards = [(i, start, end, f"{output.name}.shard{i}", shard_seed(seed, i)) for i, (start, end) in enumerate(ranges)]
+
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(sample_probs, corpus_path, corpus_ids)) as pool:
+        shard_num_lines = pool.map(sample_shard, shards)
+
+    # concatenate the shards in corpus order, numbering the contexts of each word and the lines globally
+    line_offset = 0
+    for shard, num_lines in zip(shards, shard_num_lines):
+        with open(shard[3], 'r') as shard_file:
+            for row in shard_file:
+                token, context_len, focus_start, focus_len, context, line_no = row.rstrip('\n').split('\t')
+                counter[token] += 1
+                print(token, counter[token], context_len, focus_start, focus_len, context, int(line_no) + line_offset,
+                      file=output, sep='\t')
+        os.remove(shard[3])
+        line_offset += num_lines
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--query-words', dest='query_words', type=argparse.FileType('r'), required=True,
                         help='File of query words to sample contexts for')
-    parser.add_argument('--output', type=argparse.FileType('w'), required=True, help='File to write samples to')
+    parser.add_argument('--output', type=argparse.FileType('w'), required=True,
+                        help='File to write samples to; compressed if the file name ends with .gz, .bz2 or .zst')
     parser.add_argument('--vocab', type=argparse.FileType('r'), required=True,
                         help='Vocabulary file corresponding to the corpus file, as generated from corpus_tokenizer.py')
-    parser.add_argument('--corpus', type=argparse.FileType('rb'), required=True,
-                        help='Processed corpus file, as generated from corpus_tokenizer.py')
+    corpus_group = parser.add_mutually_exclusive_group(required=True)
+    corpus_group.add_argument('--corpus', type=argparse.FileType('rb'),
+                              help='Processed corpus file, as generated from corpus_tokenizer.py; optionally gzip-, '
+                                   'bz2- or zstd-compressed')
+    corpus_group.add_argument('--corpus-ids', dest='corpus_ids', type=str,
+                              help='File prefix of a binary processed corpus, as generated from corpus_tokenizer.py '
+                                   'with --ids-output')
+    parser.add_argument('--index', type=str,
+                        help='File prefix of an occurrence index of the corpus, as generated from index_corpus.py; '
+                             'if given, exactly COUNT contexts per query word (or all, if there are fewer) are drawn '
+                             'from the index, and only the chosen lines are read from the corpus')
     parser.add_argument('--count', type=int,
                         help='(Approximate) number of contexts to sample from the corpus, per query word',
                         default=100)
+    parser.add_argument('--wordpiece-cache-size', dest='wordpiece_cache_size', type=int, default=1_000_000,
+                        help='Number of words whose wordpiece tokenization is cached')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to sample with; each samples from a contiguous part of the corpus '
+                             'with its own random seed derived from --seed')
+    parser.add_argument('--seed', type=int, default=15452, help='Random seed')
     args = parser.parse_args()
     print(args, file=sys.stderr)
+    WORDPIECES.maxsize = args.wordpiece_cache_size
+    if args.corpus is not None:
+        args.corpus = open_input(args.corpus)
+        if is_compressed(args.corpus) and (args.workers > 1 or args.index is not None):
+            parser.error('--workers and --index require an uncompressed corpus file')
+    index = None
+    if args.index is not None:
+        # the index has to belong to the given corpus: its offsets are byte offsets into a text corpus, or line numbers
+        # of a binary one
+        index = OccurrenceIndex(args.index)
+        meta = corpus_meta(corpus_path=args.corpus.name if args.corpus is not None else None,
+                           corpus_ids=args.corpus_ids)
+        if index.meta is None:
+            parser.error(f"--index {args.index} has no {args.index}.meta; build it again with index_corpus.py")
+        if index.meta['corpus'] != meta['corpus']:
+            kinds = {'text': 'a text corpus (--corpus)', 'ids': 'a binary corpus (--corpus-ids)'}
+            parser.error(f"--index {args.index} was built from {kinds[index.meta['corpus']]}, not from "
+                         f"{kinds[meta['corpus']]}")
+        if index.meta['size'] != meta['size']:
+            parser.error(f"--index {args.index} was built from a corpus of another size ({index.meta['size']} "
+                         f"bytes instead of {meta['size']}); build it again with index_corpus.py")
+    args.output = open_output(args.output)
 
     print("loading vocabulary", file=sys.stderr, flush=True)
     vocab = {line.strip().split(' ')[0]: int(line.strip().split(' ')[1]) for line in args.vocab}
@@ -109,12 +235,34 @@ if __name__ == '__main__':
     args.query_words.close()
     del vocab
 
-    random.seed(15452)
-    print('token', 'counter', 'context_len', 'focus_index', 'focus_len', 'context', file=args.output, sep='\t')
-    for token, context, focus_start, focus_len in generate_contexts(sample_probs, args.corpus):
-        assert len(context) <= 510
-        counter[token] += 1
-        print(token, counter[token], len(context), focus_start, focus_len, ' '.join(context), file=args.output,
-              sep='\t')
+    corpus = TokenCorpus(args.corpus_ids) if args.corpus_ids is not None else None
+
+    print('token', 'counter', 'context_len', 'focus_index', 'focus_len', 'context', 'line', file=args.output,
+          sep='\t')
+    if index is not None:
+        words, occurrences = sample_occurrences(index, [w for w in sample_probs if w in index], args.count,
+                                                random.Random(args.seed))
+        for token, occurrence, context in zip(words, occurrences,
+                                              read_lines(occurrences, corpus_file=args.corpus, corpus=corpus)):
+            counter[token] += 1
+            print(token, counter[token], len(context), occurrence['index'], occurrence['length'],
+                  format_context(context, corpus is not None), occurrence['line'], file=args.output, sep='\t')
+    elif args.workers > 1:
+        if args.corpus is not None:
+            args.corpus.close()
+        sample_parallel(sample_probs, counter, args.workers, args.seed, args.output,
+                        corpus_path=args.corpus.name if args.corpus is not None else None, corpus_ids=args.corpus_ids)
+    else:
+        if corpus is not None:
+            lines = ids_line_iter(corpus)
+        else:
+            lines = line_iter(args.corpus)
+        for token, line_no, context, focus_start, focus_len in generate_contexts(
+                sample_probs, lines, as_ids=corpus is not None, rng=random.Random(args.seed)):
+            assert len(context) <= 510
+            counter[token] += 1
+            print(token, counter[token], len(context), focus_start, focus_len,
+                  format_context(context, corpus is not None), line_no, file=args.output, sep='\t')
 
     args.output.close()
+    print(WORDPIECES.stats(), file=sys.stderr)
@@ -1,14 +1,24 @@
 import argparse
-import collections
+import functools
 import itertools
+import multiprocessing
 import os
+import shutil
 import sys
 
+import numpy as np
 import regex
 from spacy.lang.de import German
 from tqdm import tqdm
 from transformers import BertTokenizer
 
+from bert_model import MODEL_NAME
+from compressed_io import is_compressed, open_input, open_output, progress_line_iter
+from counting import make_counter
+from shards import line_aligned_ranges
+from token_corpus import IDS_DTYPE, TokenCorpusWriter
+from wordpiece_cache import CachedWordpieceTokenizer
+
 
 def _tokenize_text(text):
     # emulates BERT's tokenization into words (not pieces),
@@ -25,67 +35,187 @@ def _tokenize_text(text):
         yield s
 
 
-def sentencize(text):
+@functools.lru_cache(maxsize=None)
+def _sentencizer():
     nlp = German()
     nlp.add_pipe(nlp.create_pipe('sentencizer'))
     nlp.max_length = 100_000_000
-    for sent in nlp(text).sents:
+    return nlp
+
+
+def sentencize(text):
+    for sent in _sentencizer()(text).sents:
         yield sent.string
 
 
-def sentence_iter(corpus_file):
-    with tqdm(unit='B', unit_scale=True, smoothing=0.05, total=os.path.getsize(corpus_file.name)) as pbar:
-        accumulator = ''
-        for line in corpus_file:
-            pbar.update(len(line))
-            accumulator += line.decode('utf-8')
-            if len(accumulator) > 1_000_000:
-                sentences = list(sentencize(accumulator))
-                for sent in sentences[:-2]:
-                    tokenized = list(_tokenize_text(sent))
-                    if len(tokenized) > 510:
-                        continue
-                    yield tokenized
-
-                accumulator = sentences[-1]
-
-        # process remaining text in the accumulator
-        for sent in sentencize(accumulator):
-            tokenized = list(_tokenize_text(sent))
-            if len(tokenized) > 510:
-                continue
+def stream_sentences(texts, chunk_size=1_000_000):
+    # Collects the text pieces until the buffer exceeds chunk_size characters, then sentencizes it.
+    # All but the last sentence are emitted; the last one may continue in the next piece and is
+    # carried over, unless it has grown to half the buffer size (i.e. the text has no boundaries).
+    buffer = []
+    buffer_len = 0
+    for text in texts:
+        buffer.append(text)
+        buffer_len += len(text)
+        if buffer_len > chunk_size:
+            sentences = list(sentencize(''.join(buffer)))
+            carry = sentences.pop() if sentences else ''
+            yield from sentences
+            if len(carry) > chunk_size // 2:
+                yield carry
+                carry = ''
+            buffer, buffer_len = [carry], len(carry)
+
+    if buffer_len > 0:
+        yield from sentencize(''.join(buffer))
+
+
+def sentence_iter(corpus_file, start=0, end=None, position=None):
+    lines = progress_line_iter(corpus_file, start, end, position=position, smoothing=0.05)
+    for sent in stream_sentences(line.decode('utf-8') for line in lines):
+        tokenized = list(_tokenize_text(sent))
+        if len(tokenized) > 510:
+            continue
+        yield tokenized
 
     corpus_file.close()
 
 
+def load_tokenizer():
+    tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
+    tokenizer.do_basic_tokenize = False
+    return tokenizer
+
+
+def tokenize_sentences(sentences, wordpieces, frequencies, output=None, ids_output=None):
+    vocab = wordpieces.wordpiece_tokenizer.vocab
+    for sent in sentences:
+        sent = list(sent)
+
+        subword_tokens = list(itertools.chain(*map(wordpieces.tokenize, sent)))
+        if len(subword_tokens) > 510:
+            continue
+        if output is not None:
+            print(*subword_tokens, end='\n', sep=' ', file=output)
+        if ids_output is not None:
+            ids_output.write([vocab[piece] for piece in subword_tokens])
+        frequencies.update(sent)
+
+
+_worker_wordpieces = None
+_worker_counter_args = None
+
+
+def _init_worker(cache_size, counter_args):
+    global _worker_wordpieces, _worker_counter_args
+    _worker_wordpieces = CachedWordpieceTokenizer(load_tokenizer().wordpiece_tokenizer, maxsize=cache_size)
+    _worker_counter_args = counter_args
+
+
+def tokenize_shard(shard):
+    index, input_path, start, end, output_path, ids_prefix = shard
+    frequencies = make_counter(**_worker_counter_args)
+    output = open(output_path, 'w') if output_path is not None else None
+    ids_output = TokenCorpusWriter(ids_prefix) if ids_prefix is not None else None
+    with open(input_path, 'rb') as corpus_file:
+        tokenize_sentences(sentence_iter(corpus_file, start, end, position=index), _worker_wordpieces, frequencies,
+                           output=output, ids_output=ids_output)
+    for o in (output, ids_output):
+        if o is not None:
+            o.close()
+    print(f"shard {index}:", _worker_wordpieces.stats(), file=sys.stderr, flush=True)
+    return frequencies
+
+
+def tokenize_parallel(input_path, num_workers, cache_size, counter_args, output=None, ids_output=None):
+    # each worker tokenizes a line-aligned byte range of the input into its own shard file(s); the shards
+    # are concatenated in input order, so that the output does not depend on worker scheduling.
+    ranges = line_aligned_ranges(input_path, num_workers)
+    shards = [(i, input_path, start, end,
+               f"{output.name}.shard{i}" if output is not None else None,
+               f"{ids_output.prefix}.shard{i}" if ids_output is not None else None)
+              for i, (start, end) in enumerate(ranges)]
+
+    frequencies = make_counter(**counter_args)
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(cache_size, counter_args)) as pool:
+        for shard_frequencies in pool.imap(tokenize_shard, shards):
+            frequencies.merge(shard_frequencies)
+
+    for _, _, _, _, output_path, ids_prefix in shards:
+        if output_path is not None:
+            with open(output_path, 'r') as shard_file:
+                shutil.copyfileobj(shard_file, output)
+            os.remove(output_path)
+        if ids_prefix is not None:
+            ids_output.append_corpus(ids_prefix)
+            os.remove(ids_prefix + '.ids')
+            os.remove(ids_prefix + '.offsets')
+
+    return frequencies
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input', type=argparse.FileType('rb'), required=True, help='Unprocessed corpus file')
-    parser.add_argument('--output', type=argparse.FileType('w'), required=True,
-                        help='File to write the tokenized and sentencized corpus to')
+    parser.add_argument('--input', type=argparse.FileType('rb'), required=True,
+                        help='Unprocessed corpus file, optionally gzip-, bz2- or zstd-compressed')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        help='File to write the tokenized and sentencized corpus to; compressed if the file name ends '
+                             'with .gz, .bz2 or .zst')
+    parser.add_argument('--ids-output', dest='ids_output', type=str,
+                        help='File prefix to write the tokenized and sentencized corpus to in binary form, '
+                             'i.e. as packed uint16 token ids (PREFIX.ids) with line offsets (PREFIX.offsets)')
     parser.add_argument('--vocab-out', dest='vocab_file', type=argparse.FileType('w'), required=True,
                         help='File to write token frequencies to')
     parser.add_argument('--vocab-limit', dest='vocab_limit', type=int,
                         help='Limits the written vocabulary to the top N most frequent words', default=20_000_000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to tokenize with; the input is split into line-aligned byte ranges '
+                             '(sentences spanning a range boundary are split there)')
+    parser.add_argument('--wordpiece-cache-size', dest='wordpiece_cache_size', type=int, default=1_000_000,
+                        help='Number of words whose wordpiece tokenization is cached (per worker)')
+    parser.add_argument('--count-memory', dest='count_memory', type=int,
+                        help='Maximum number of distinct words whose frequencies are held in memory (per worker); '
+                             'exceeding counts are spilled to disk and merged in the end. Unlimited by default')
+    parser.add_argument('--approximate-counting', dest='approximate_counting', action='store_true',
+                        help='Instead of spilling to disk, approximate the frequencies with a Misra-Gries summary '
+                             'of 2 * COUNT_MEMORY counters; frequencies are underestimated')
+    parser.add_argument('--tmp-dir', dest='tmp_dir', type=str, help='Directory for spilled frequency counts')
     args = parser.parse_args()
     print(args, file=sys.stderr)
-
-    tokenizer = BertTokenizer.from_pretrained("deepset/gbert-base")
-    tokenizer.do_basic_tokenize = False
-
-    frequencies = collections.defaultdict(lambda: 0)
-    for sent in sentence_iter(args.input):
-        sent = list(sent)
-
-        subword_tokens = list(itertools.chain(*map(tokenizer.wordpiece_tokenizer.tokenize, sent)))
-        if len(subword_tokens) > 510:
-            continue
-        print(*subword_tokens, end='\n', sep=' ', file=args.output)
-        for tok in sent:
-            frequencies[tok] += 1
-    args.output.close()
-
-    sorted_output = list(reversed(sorted(frequencies.items(), key=lambda it: it[1])))
-    for o in tqdm(sorted_output[:args.vocab_limit]):
-        print(o[0], o[1], file=args.vocab_file)
+    if args.output is None and args.ids_output is None:
+        parser.error('at least one of --output and --ids-output is required')
+    if args.approximate_counting and args.count_memory is None:
+        parser.error('--approximate-counting requires --count-memory')
+    counter_args = dict(max_items=args.count_memory, approximate=args.approximate_counting, tmp_dir=args.tmp_dir)
+    args.input = open_input(args.input)
+    if args.workers > 1 and is_compressed(args.input):
+        parser.error('--workers requires an uncompressed input file')
+    if args.output is not None:
+        args.output = open_output(args.output)
+
+    tokenizer = load_tokenizer()
+    ids_output = None
+    if args.ids_output is not None:
+        assert len(tokenizer.vocab) <= np.iinfo(IDS_DTYPE).max + 1
+        ids_output = TokenCorpusWriter(args.ids_output)
+
+    if args.workers > 1:
+        args.input.close()
+        frequencies = tokenize_parallel(args.input.name, args.workers, args.wordpiece_cache_size, counter_args,
+                                        output=args.output, ids_output=ids_output)
+    else:
+        wordpieces = CachedWordpieceTokenizer(tokenizer.wordpiece_tokenizer, maxsize=args.wordpiece_cache_size)
+        frequencies = make_counter(**counter_args)
+        tokenize_sentences(sentence_iter(args.input), wordpieces, frequencies, output=args.output,
+                           ids_output=ids_output)
+        print(wordpieces.stats(), file=sys.stderr, flush=True)
+    for o in (args.output, ids_output):
+        if o is not None:
+            o.close()
+
+    if args.approximate_counting:
+        print(f"approximate frequencies underestimate by at most {frequencies.decrement}", file=sys.stderr)
+    for token, count in tqdm(frequencies.most_common(args.vocab_limit)):
+        print(token, count, file=args.vocab_file)
+    frequencies.close()
     args.vocab_file.close()
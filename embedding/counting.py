@@ -0,0 +1,112 @@
+import collections
+import heapq
+import itertools
+import os
+import tempfile
+
+
+def _sum_sorted_counts(sorted_counts):
+    # sums the counts of equal (adjacent) tokens in a stream of (token, count) pairs sorted by token
+    for token, group in itertools.groupby(sorted_counts, key=lambda it: it[0]):
+        yield token, sum(count for _, count in group)
+
+
+def _read_run(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            token, count = line.rstrip('\n').split('\t')
+            yield token, int(count)
+
+
+def _top_n(counts, n):
+    # heap-based selection of the n most frequent tokens; ties are kept in the order of the input
+    if n is None:
+        return sorted(counts, key=lambda it: it[1], reverse=True)
+    return heapq.nlargest(n, counts, key=lambda it: it[1])
+
+
+class SpillingCounter:
+    # Counts tokens exactly with at most max_items distinct tokens in memory. Whenever the limit is
+    # exceeded, the counts are written to disk as a run sorted by token, and the runs are merged when
+    # the most frequent tokens are requested. Tokens must not contain tabs or newlines.
+
+    def __init__(self, max_items=None, tmp_dir=None):
+        self.max_items = max_items
+        self.tmp_dir = tmp_dir
+        self.counts = collections.Counter()
+        self.runs = []
+
+    def update(self, tokens):
+        self.counts.update(tokens)
+        if self.max_items is not None and len(self.counts) > self.max_items:
+            self.spill()
+
+    def spill(self):
+        if len(self.counts) == 0:
+            return
+        fd, path = tempfile.mkstemp(prefix='counts-', suffix='.tsv', dir=self.tmp_dir)
+        with open(fd, 'w', encoding='utf-8') as f:
+            for token, count in sorted(self.counts.items()):
+                print(token, count, sep='\t', file=f)
+        self.runs.append(path)
+        self.counts = collections.Counter()
+
+    def merge(self, other):
+        self.runs.extend(other.runs)
+        self.update(other.counts)
+
+    def most_common(self, n=None):
+        streams = [_read_run(path) for path in self.runs] + [iter(sorted(self.counts.items()))]
+        return _top_n(_sum_sorted_counts(heapq.merge(*streams, key=lambda it: it[0])), n)
+
+    def close(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+
+
+class MisraGriesCounter:
+    # Approximate counting with at most 2 * max_items counters (Misra-Gries summary). The reported
+    # counts underestimate the true counts by at most (number of tokens) / (max_items + 1); every
+    # token more frequent than that is guaranteed to be kept.
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.counts = collections.Counter()
+        self.total = 0
+        self.decrement = 0
+
+    def update(self, tokens):
+        tokens = list(tokens)
+        self.total += len(tokens)
+        self.counts.update(tokens)
+        if len(self.counts) > 2 * self.max_items:
+            self._reduce()
+
+    def _reduce(self):
+        if len(self.counts) <= self.max_items:
+            return
+        # subtracting the (max_items + 1)-th largest count from all counters equals that many rounds
+        # of the decrement step of the original algorithm, and leaves at most max_items counters
+        threshold = heapq.nlargest(self.max_items + 1, self.counts.values())[-1]
+        self.decrement += threshold
+        self.counts = collections.Counter({t: c - threshold for t, c in self.counts.items() if c > threshold})
+
+    def merge(self, other):
+        self.total += other.total
+        self.decrement += other.decrement
+        self.counts.update(other.counts)
+        self._reduce()
+
+    def most_common(self, n=None):
+        return _top_n(sorted(self.counts.items()), n)
+
+    def close(self):
+        pass
+
+
+def make_counter(max_items=None, approximate=False, tmp_dir=None):
+    if approximate:
+        assert max_items is not None, 'approximate counting requires a memory limit'
+        return MisraGriesCounter(max_items)
+    return SpillingCounter(max_items, tmp_dir=tmp_dir)
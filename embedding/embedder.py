@@ -1,12 +1,26 @@
 import argparse
+import collections
+import os
+import shutil
+import subprocess
 import sys
 
 import numpy as np
-import pandas
 import torch
 from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
-from transformers import AutoModel, BertTokenizer
+from transformers import AutoConfig, AutoModel, BertTokenizer
+
+from batching import DedupStats, PaddingStats, plan_batches
+from bert_model import MODEL_NAME, torch_version
+from compressed_io import detect_compression
+from context_reader import ContextReader
+from context_store import ContextStoreWriter
+from embedding_output import ContainerWriter, Journal, Word2VecWriter, merge_containers, merge_word2vec
+from onnx_backend import ensure_onnx, load_onnx_encoder
+from pipeline import BackgroundWorker, background_iter
+from shards import balanced_partition
+from token_corpus import TokenCorpus
 
 
 class AllSet:
@@ -15,87 +29,499 @@ class AllSet:
         return True
 
 
-def generate_type_embeddings(embeddings, vectorizations, poolings, aggregations):
-    def meannorm(vectors):
-        normalized_input = torch.stack([v / torch.norm(v) for v in vectors])
-        mean = torch.mean(normalized_input, axis=0)
-        return mean / torch.norm(mean)
-
-    def fractional_medoid(vectors, p):
-        distances = torch.cdist(vectors, vectors, p=p).sum(axis=1)
-        assert all(distances != np.inf)
-        return vectors[torch.argmin(distances)]
-
-    def embeddings_to_subword_vectors(embeddings):
-        num_contexts, num_subwords, _, _ = embeddings.shape
-        if 'alllayers' in vectorizations: yield 'alllayers', embeddings.reshape(num_contexts, num_subwords, 13 * 768)
-        if 'layer1to4' in vectorizations: yield 'layer1to4', embeddings[:,:,[1,2,3,4],:].reshape(num_contexts, num_subwords, 4*768)
-        if 'layer9to12' in vectorizations: yield 'layer9to12', embeddings[:,:,[9,10,11,12],:].reshape(num_contexts, num_subwords, 4*768)
-
-        if 'sum' in vectorizations: yield 'sum', embeddings.sum(axis=2)
-        if 'inputemb' in vectorizations: yield 'inputemb', embeddings[:, :, 0, :]
-        for i in range(1, 13):
-            if 'layer' + str(i) in vectorizations: yield 'layer' + str(i), embeddings[:, :, i, :]
-
-    def pool_subword_vectors_to_token_vectors(embedding_subword_vectors):
-        num_contexts, num_subwords, vector_len = embedding_subword_vectors.shape
-        if 'nopooling' in poolings: yield 'nopooling', embedding_subword_vectors.reshape(num_contexts * num_subwords, vector_len)
-
-        if 'mean' in poolings: yield 'mean', torch.mean(embedding_subword_vectors, dim=1)
-        if 'median' in poolings: yield 'median', torch.quantile(embedding_subword_vectors, dim=1, q=0.5)
-        if 'meannorm' in poolings: yield 'meannorm', torch.stack([meannorm(v) for v in embedding_subword_vectors])
-        if 'first' in poolings: yield 'first', embedding_subword_vectors[:, 0, :]
-        if 'last' in poolings: yield 'last', embedding_subword_vectors[:, -1, :]
-        if 'l0.5medoid' in poolings: yield 'l0.5medoid', torch.stack([fractional_medoid(v, 0.5) for v in embedding_subword_vectors])
-        if 'l1medoid' in poolings: yield 'l1medoid', torch.stack([fractional_medoid(v, 1) for v in embedding_subword_vectors])
-        if 'l2medoid' in poolings: yield 'l2medoid', torch.stack([fractional_medoid(v, 2) for v in embedding_subword_vectors])
-
-    def aggregate_token_vectors(token_vectors):
-        if 'mean' in aggregations: yield 'mean', torch.mean(token_vectors, dim=0)
-        if 'median' in aggregations: yield 'median', torch.quantile(token_vectors, dim=0, q=0.5)
-        if 'meannorm' in aggregations: yield 'meannorm', meannorm(token_vectors)
-        if 'l0.5medoid' in aggregations: yield 'l0.5medoid', fractional_medoid(token_vectors, 0.5)
-        if 'l1medoid' in aggregations: yield 'l1medoid', fractional_medoid(token_vectors, 1)
-        if 'l2medoid' in aggregations: yield 'l2medoid', fractional_medoid(token_vectors, 2)
-
-    for vectorization, subword_vectors in embeddings_to_subword_vectors(embeddings):
-        for pooling, token_vectors in pool_subword_vectors_to_token_vectors(subword_vectors):
-            for aggregation, type_vector in aggregate_token_vectors(token_vectors):
-                yield '-'.join([vectorization, pooling, aggregation]), type_vector
-
-
-def forwardpass(inputs, model, tokenizer):
+def vectorization_names(num_layers=13):
+    # all vectorizations of a model with num_layers hidden states (0 being the input embeddings)
+    names = ['sum', 'alllayers', 'inputemb'] + ['layer' + str(i) for i in range(1, num_layers)]
+    if num_layers > 4: names.append('layer1to4')
+    if num_layers > 12: names.append('layer9to12')
+    return names
+
+
+def required_layers(vectorizations, num_layers=13):
+    # the hidden states (0 being the input embeddings) needed for the given vectorizations
+    if not isinstance(vectorizations, AllSet):
+        unknown = [v for v in vectorizations if v not in vectorization_names(num_layers)]
+        if len(unknown) > 0 or len(vectorizations) == 0:
+            raise ValueError(f"unknown vectorizations {unknown} for a model with {num_layers - 1} layers; choose from "
+                             f"{', '.join(vectorization_names(num_layers))}")
+    if 'alllayers' in vectorizations or 'sum' in vectorizations:
+        return list(range(num_layers))
+    layers = set()
+    if 'layer1to4' in vectorizations: layers.update([1, 2, 3, 4])
+    if 'layer9to12' in vectorizations: layers.update([9, 10, 11, 12])
+    if 'inputemb' in vectorizations: layers.add(0)
+    for i in range(1, num_layers):
+        if 'layer' + str(i) in vectorizations: layers.add(i)
+    return sorted(layers)
+
+
+def meannorm(vectors):
+    # the normalized mean of the normalized vectors along the second to last axis, batched over any leading axes
+    normalized_input = vectors / torch.norm(vectors, dim=-1, keepdim=True)
+    mean = torch.mean(normalized_input, dim=-2)
+    return mean / torch.norm(mean, dim=-1, keepdim=True)
+
+
+def fractional_medoid(vectors, p, chunk_size=2048):
+    # The vector with the least sum of l_p distances to the others along the second to last axis, batched over
+    # any leading axes. For more than chunk_size vectors, the distance sums are computed in chunks of rows, so
+    # that only a chunk_size x n block of distances is held at once.
+    n = vectors.shape[-2]
+    if n <= chunk_size:
+        distances = torch.cdist(vectors, vectors, p=p).sum(axis=-1)
+    else:
+        distances = torch.cat([torch.cdist(vectors[..., i:i + chunk_size, :], vectors, p=p).sum(axis=-1)
+                               for i in range(0, n, chunk_size)], dim=-1)
+    assert torch.all(distances != np.inf)
+    index = torch.argmin(distances, dim=-1)
+    return vectors.gather(-2, index[..., None, None].expand(*index.shape, 1, vectors.shape[-1])).squeeze(-2)
+
+
+# poolings and aggregations that work on every dimension separately: applied to a concatenation of layers,
+# they give the concatenation of their results on the single layers
+ELEMENTWISE_POOLINGS = {'nopooling', 'mean', 'median', 'first', 'last'}
+ELEMENTWISE_AGGREGATIONS = {'mean', 'median'}
+MEDOID_P = {'l0.5medoid': 0.5, 'l1medoid': 1, 'l2medoid': 2}
+
+
+def combine_distances(distances, p):
+    # the l_p distances between concatenated vectors, from the l_p distances between their parts
+    if p == 1:
+        return torch.stack(distances).sum(axis=0)
+    return torch.stack(distances).pow(p).sum(axis=0).pow(1 / p)
+
+
+def medoid(vectors, distances):
+    # the vector with the least sum of distances to the others along the second to last axis (batched)
+    distance_sums = distances.sum(axis=-1)
+    assert torch.all(distance_sums != np.inf)
+    index = torch.argmin(distance_sums, dim=-1)
+    return vectors.gather(-2, index[..., None, None].expand(*index.shape, 1, vectors.shape[-1])).squeeze(-2)
+
+
+class TensorCache:
+    # memoizes computed tensors by key, evicting the least recently used ones beyond a budget in bytes
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.tensors = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self.tensors:
+            self.tensors.move_to_end(key)
+            self.hits += 1
+            return self.tensors[key]
+        self.misses += 1
+        tensor = compute()
+        size = tensor.element_size() * tensor.nelement()
+        if size <= self.budget:
+            self.tensors[key] = tensor
+            self.size += size
+            while self.size > self.budget:
+                _, evicted = self.tensors.popitem(last=False)
+                self.size -= evicted.element_size() * evicted.nelement()
+        return tensor
+
+
+def generate_type_embeddings(embeddings, vectorizations, poolings, aggregations, layers=None,
+                             memory_budget=1 << 30, medoid_chunk_size=2048):
+    # Embeddings are of shape contexts x subwords x layers x hidden size; layers are the indices of the
+    # hidden states contained (by default all of them). A vectorization is either 'sum' or a sequence of
+    # layers that are concatenated. Intermediate results are shared between all combinations: results of
+    # elementwise poolings and aggregations on concatenated layers are concatenated from those on the single
+    # layers, and medoids of concatenated layers are found from the combined distances on the single layers.
+    # They are kept up to memory_budget bytes.
+    layers = range(embeddings.shape[2]) if layers is None else layers
+    position = {layer: i for i, layer in enumerate(layers)}
+    num_contexts, num_subwords, _, hidden_size = embeddings.shape
+    cache = TensorCache(memory_budget)
+
+    def has_layers(*ls):
+        return all(l in position for l in ls)
+
+    def subword_vectors(vectorization):
+        # contexts x subwords x vector length
+        if vectorization == 'sum':
+            return cache.get(('subwords', 'sum'), lambda: embeddings.sum(axis=2))
+        if len(vectorization) == 1:
+            return embeddings[:, :, position[vectorization[0]], :]
+        return cache.get(('subwords', vectorization), lambda: embeddings[:, :, [position[l] for l in vectorization], :]
+                         .reshape(num_contexts, num_subwords, len(vectorization) * hidden_size))
+
+    def concatenated(vectorization):
+        return vectorization != 'sum' and len(vectorization) > 1
+
+    def distances(vectorization, pooling, p):
+        # pairwise l_p distances between the token vectors of a pooling, or, without pooling, between the
+        # subword vectors of every context
+        def compute():
+            if concatenated(vectorization) and (pooling is None or pooling in ELEMENTWISE_POOLINGS):
+                return combine_distances([distances((l,), pooling, p) for l in vectorization], p)
+            vectors = subword_vectors(vectorization) if pooling is None else pool(vectorization, pooling)
+            return torch.cdist(vectors, vectors, p=p)
+        return cache.get(('distances', vectorization, pooling, p), compute)
+
+    def pool(vectorization, pooling):
+        def compute():
+            if concatenated(vectorization) and pooling in ELEMENTWISE_POOLINGS:
+                return torch.cat([pool((l,), pooling) for l in vectorization], dim=-1)
+            vectors = subword_vectors(vectorization)
+            if pooling == 'nopooling': return vectors.reshape(num_contexts * num_subwords, vectors.shape[-1])
+            if pooling == 'mean': return torch.mean(vectors, dim=1)
+            if pooling == 'median': return torch.quantile(vectors, dim=1, q=0.5)
+            if pooling == 'meannorm': return meannorm(vectors)
+            if pooling == 'first': return vectors[:, 0, :]
+            if pooling == 'last': return vectors[:, -1, :]
+            return medoid(vectors, distances(vectorization, None, MEDOID_P[pooling]))
+        return cache.get(('pool', vectorization, pooling), compute)
+
+    def aggregate(vectorization, pooling, aggregation):
+        def compute():
+            if concatenated(vectorization) and pooling in ELEMENTWISE_POOLINGS \
+                    and aggregation in ELEMENTWISE_AGGREGATIONS:
+                return torch.cat([aggregate((l,), pooling, aggregation) for l in vectorization], dim=-1)
+            token_vectors = pool(vectorization, pooling)
+            if aggregation == 'mean': return torch.mean(token_vectors, dim=0)
+            if aggregation == 'median': return torch.quantile(token_vectors, dim=0, q=0.5)
+            if aggregation == 'meannorm': return meannorm(token_vectors)
+            if len(token_vectors) > medoid_chunk_size:
+                # too many vectors to keep their distances
+                return fractional_medoid(token_vectors, MEDOID_P[aggregation], chunk_size=medoid_chunk_size)
+            return medoid(token_vectors, distances(vectorization, pooling, MEDOID_P[aggregation]))
+        return cache.get(('aggregate', vectorization, pooling, aggregation), compute)
+
+    def selected_vectorizations():
+        if 'alllayers' in vectorizations: yield 'alllayers', tuple(layers)
+        if 'layer1to4' in vectorizations and has_layers(1, 2, 3, 4): yield 'layer1to4', (1, 2, 3, 4)
+        if 'layer9to12' in vectorizations and has_layers(9, 10, 11, 12): yield 'layer9to12', (9, 10, 11, 12)
+
+        if 'sum' in vectorizations: yield 'sum', 'sum'
+        if 'inputemb' in vectorizations and has_layers(0): yield 'inputemb', (0,)
+        for i in range(1, max(layers, default=0) + 1):
+            if 'layer' + str(i) in vectorizations and has_layers(i): yield 'layer' + str(i), (i,)
+
+    selected_poolings = [p for p in ['nopooling', 'mean', 'median', 'meannorm', 'first', 'last', 'l0.5medoid',
+                                     'l1medoid', 'l2medoid'] if p in poolings]
+    selected_aggregations = [a for a in ['mean', 'median', 'meannorm', 'l0.5medoid', 'l1medoid', 'l2medoid']
+                             if a in aggregations]
+
+    for vectorization_name, vectorization in selected_vectorizations():
+        for pooling in selected_poolings:
+            for aggregation in selected_aggregations:
+                yield '-'.join([vectorization_name, pooling, aggregation]), aggregate(vectorization, pooling,
+                                                                                      aggregation)
+
+
+def encode_inputs(inputs, tokenizer, pin_memory=False):
     for i in inputs:
         assert len(i) <= 510
 
-    input_seq = [torch.tensor(tokenizer.build_inputs_with_special_tokens(tokenizer.convert_tokens_to_ids(i))) for i in
-                 inputs]
-    input_cuda = pad_sequence(input_seq, batch_first=True).to('cuda')
-    attention_tensor = (input_cuda != 0).int().to('cuda')
-    outputs = model(input_cuda, attention_mask=attention_tensor, output_hidden_states=True)
-    inner_layers = outputs[2]
-    permuted = torch.stack(list(inner_layers)).permute(1, 2, 0, 3).detach()
+    # inputs are either lists of wordpieces, or arrays of token ids read from a binary corpus
+    input_seq = [torch.tensor(tokenizer.build_inputs_with_special_tokens(
+        i.tolist() if isinstance(i, np.ndarray) else tokenizer.convert_tokens_to_ids(i))) for i in inputs]
+    input_ids = pad_sequence(input_seq, batch_first=True)
+    attention_mask = (input_ids != 0).int()
+    if pin_memory:
+        # page-locked, so that the copy to the device can run asynchronously
+        input_ids, attention_mask = input_ids.pin_memory(), attention_mask.pin_memory()
+    return input_ids, attention_mask
+
+
+def forward_encoded(input_ids, attention_mask, model, device='cuda', layers=None, spans=None):
+    input_cuda = input_ids.to(device, non_blocking=True)
+    attention_tensor = attention_mask.to(device, non_blocking=True)
+    if hasattr(model, 'hidden_states'):
+        # another inference backend, cf. OnnxEncoder
+        inner_layers = model.hidden_states(input_cuda, attention_tensor, layers)
+    else:
+        outputs = model(input_cuda, attention_mask=attention_tensor, output_hidden_states=True)
+        inner_layers = outputs[2]
+        if layers is not None:
+            inner_layers = [inner_layers[l] for l in layers]
     del input_cuda
     del attention_tensor
-    return permuted, input_seq
+    if spans is not None:
+        # gather only the focus rows (spans of (input, focus_index, focus_len), shifted by the start token) of
+        # the requested layers on the device, and return them as one (focus_len x layers x hidden) tensor per span
+        rows = torch.tensor([j for j, _, length in spans for _ in range(length)], device=device)
+        cols = torch.tensor([start + 1 + k for _, start, length in spans for k in range(length)], device=device)
+        gathered = torch.stack([h[rows, cols] for h in inner_layers], dim=1).detach()
+        return gathered.split([length for _, _, length in spans])
+    return torch.stack(list(inner_layers)).permute(1, 2, 0, 3).detach()
+
+
+def forwardpass(inputs, model, tokenizer, device='cuda', layers=None, spans=None):
+    # spans, if given, are one (focus_index, focus_len) per input
+    input_ids, attention_mask = encode_inputs(inputs, tokenizer)
+    spans = None if spans is None else [(j, start, length) for j, (start, length) in enumerate(spans)]
+    return forward_encoded(input_ids, attention_mask, model, device=device, layers=layers, spans=spans), \
+        [i[:int(n)] for i, n in zip(input_ids, attention_mask.sum(axis=1))]
+
+
+def context_inputs(contexts, corpus=None):
+    # the inputs of a word's contexts, either as lists of wordpieces or as token ids from a binary corpus
+    if corpus is not None:
+        return [corpus[line] for line in contexts['line']]
+    return [x.split(' ') for x in contexts['context']]
+
+
+class WindowBatches:
+    # The contexts of several focus words, packed into batches of similar length (cf. plan_batches) and
+    # encoded to padded id tensors, ready for the forward pass. Identical contexts (the same corpus line, or
+    # the same wordpieces) are passed through the model once, and serve the focus spans of all their words.
+
+    def __init__(self, words, tokenizer, corpus=None, token_budget=16384, max_batch_size=256, pin_memory=False):
+        self.words = words
+        self.shapes = []
+        unique = dict()
+        inputs = []
+        targets = []  # per unique input, the (word, row, focus_index, focus_len) of all its contexts
+        for w, (focus_word, contexts) in enumerate(words):
+            focus_len = contexts.iloc[0]['focus_len']
+            self.shapes.append((len(contexts), focus_len))
+            keys = contexts['line'] if corpus is not None else contexts['context']
+            for j, (key, pieces, focus_index) in enumerate(zip(keys, context_inputs(contexts, corpus),
+                                                               contexts['focus_index'])):
+                if key not in unique:
+                    unique[key] = len(inputs)
+                    inputs.append(pieces)
+                    targets.append([])
+                targets[unique[key]].append((w, j, focus_index, focus_len))
+        self.num_contexts = sum(num_contexts for num_contexts, _ in self.shapes)
+        self.num_inputs = len(inputs)
+
+        self.lengths = [len(pieces) + 2 for pieces in inputs]
+        self.batches = []
+        for batch in plan_batches(self.lengths, token_budget=token_budget, max_batch_size=max_batch_size):
+            input_ids, attention_mask = encode_inputs([inputs[i] for i in batch], tokenizer, pin_memory=pin_memory)
+            spans = [(j, focus_index, focus_len) for j, i in enumerate(batch) for _, _, focus_index, focus_len in
+                     targets[i]]
+            self.batches.append((input_ids, attention_mask, spans, [(w, row) for i in batch for w, row, _, _ in
+                                                                    targets[i]], [self.lengths[i] for i in batch]))
+
+    def embed(self, model, layers, device='cuda', padding_stats=None, dedup_stats=None):
+        # Runs the forward passes, and routes the focus slice of each output back to the context embeddings
+        # (contexts x focus_len x layers x hidden) of its word, which are returned in order.
+        context_embeddings = [torch.empty((num_contexts, focus_len, len(layers), model.config.hidden_size),
+                                          device=device) for num_contexts, focus_len in self.shapes]
+        for input_ids, attention_mask, spans, targets, lengths in self.batches:
+            output = forward_encoded(input_ids, attention_mask, model, device=device, layers=layers, spans=spans)
+            for j, (w, row) in enumerate(targets):
+                context_embeddings[w][row] = output[j]
+            if padding_stats is not None:
+                padding_stats.add(lengths)
+        if dedup_stats is not None:
+            dedup_stats.add(self.num_contexts, self.num_inputs)
+        return context_embeddings
+
+
+def embed_words(words, model, tokenizer, layers, corpus=None, device='cuda', token_budget=16384, max_batch_size=256,
+                padding_stats=None):
+    # embeds the contexts of several focus words at once, cf. WindowBatches
+    return WindowBatches(words, tokenizer, corpus=corpus, token_budget=token_budget, max_batch_size=max_batch_size) \
+        .embed(model, layers, device=device, padding_stats=padding_stats)
+
+
+def word_windows(word_contexts, window_size):
+    # groups consecutive focus words (with their contexts) into windows of at least window_size contexts
+    window, num_contexts = [], 0
+    for focus_word, contexts in word_contexts:
+        window.append((focus_word, contexts))
+        num_contexts += len(contexts)
+        if num_contexts >= window_size:
+            yield window
+            window, num_contexts = [], 0
+    if len(window) > 0:
+        yield window
+
+
+class Bf16Autocast(torch.nn.Module):
+    # runs the wrapped model under bfloat16 autocast on the CPU
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    @property
+    def config(self):
+        return self.model.config
+
+    def forward(self, *args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.model(*args, **kwargs)
+
+
+def load_model(device, quantize=False, bf16=False, num_layers=None):
+    model = AutoModel.from_pretrained(MODEL_NAME)
+    if num_layers is not None:
+        # drop all transformer layers after the last needed one
+        model.encoder.layer = model.encoder.layer[:num_layers]
+        model.config.num_hidden_layers = num_layers
+    model.eval()
+    model.to(device)
+    if quantize:
+        # dynamic int8 quantization of all linear layers (weights are quantized ahead, activations on the fly)
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if bf16:
+        model = Bf16Autocast(model)
+    return model
+
+
+def worker_argv(argv, shard, num_shards, output_prefix):
+    # the command line of a worker process: the launcher's one, without --workers, for the given shard
+    worker_args = []
+    skip_next = False
+    for arg in argv:
+        if skip_next:
+            skip_next = False
+        elif arg == '--workers':
+            skip_next = True
+        elif not arg.startswith('--workers='):
+            worker_args.append(arg)
+    return worker_args + ['--shard', f"{shard}/{num_shards}", '--output-prefix', output_prefix]
+
+
+def run_workers(args, argv):
+    # Runs one embedder process per shard of the focus words, and merges their outputs. Shards that were
+    # completed by an earlier, interrupted launch are not run again.
+    shard_dir = args.output_prefix + 'shards'
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_prefixes = [os.path.join(shard_dir, f"{i}_") for i in range(args.workers)]
+    processes = []
+    for i, shard_prefix in enumerate(shard_prefixes):
+        if os.path.exists(shard_prefix + 'done'):
+            print(f"shard {i} is already complete", file=sys.stderr)
+            continue
+        processes.append((i, subprocess.Popen([sys.executable, os.path.abspath(__file__)]
+                                              + worker_argv(argv, i, args.workers, shard_prefix))))
+    failed = [i for i, process in processes if process.wait() != 0]
+    if len(failed) > 0:
+        sys.exit(f"shard(s) {', '.join(map(str, failed))} failed; run again with the same arguments to resume")
+
+    print("merging shards", file=sys.stderr, flush=True)
+    # the done markers list the words of every shard; all words are merged in sorted order, like a single run
+    # processes them (cf. ContextReader.words)
+    shard_words = []
+    for shard_prefix in shard_prefixes:
+        with open(shard_prefix + 'done', 'r', encoding='utf8') as f:
+            shard_words.append(f.read().split('\n')[:-1])
+    words = sorted(word for words_of_shard in shard_words for word in words_of_shard)
+    if args.output_format == 'container':
+        merge_containers([prefix + 'embeddings.emb' for prefix in shard_prefixes
+                          if os.path.exists(prefix + 'embeddings.emb')], args.output_prefix + 'embeddings.emb', words)
+    else:
+        merge_word2vec(shard_prefixes, shard_words, words, args.output_prefix)
+    shutil.rmtree(shard_dir)
+
+
+def pin_shard_threads(shard, num_shards, threads=None):
+    # pins the process to its share of the available cores, and uses as many intra-op threads
+    if hasattr(os, 'sched_setaffinity'):
+        cores = np.array_split(sorted(os.sched_getaffinity(0)), num_shards)[shard]
+        if len(cores) > 0:
+            os.sched_setaffinity(0, cores.tolist())
+            if threads is None:
+                torch.set_num_threads(len(cores))
+
+
+class DriftReport:
+    # collects the cosine similarities between the type vectors of a tuned model and the fp32 reference
+
+    def __init__(self):
+        self.similarities = collections.defaultdict(list)
+
+    def add(self, embedding_name, vector, reference):
+        vector, reference = vector.double().cpu(), reference.double().cpu()
+        self.similarities[embedding_name].append(
+            float(torch.dot(vector, reference) / (torch.norm(vector) * torch.norm(reference))))
+
+    def print(self, file=sys.stderr):
+        all_similarities = [s for sims in self.similarities.values() for s in sims]
+        if len(all_similarities) == 0:
+            return
+        print(f"drift against fp32: mean cosine similarity {np.mean(all_similarities):.6f}, "
+              f"min {np.min(all_similarities):.6f}", file=file)
+        for embedding_name, sims in sorted(self.similarities.items(), key=lambda it: np.min(it[1])):
+            print(embedding_name, f"{np.mean(sims):.6f}", f"{np.min(sims):.6f}", sep='\t', file=file)
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--output-prefix', required=True, type=str,
-                        help='File prefix for embedding output files; binary word2vec format')
+                        help='File prefix for embedding output files')
+    parser.add_argument('--output-format', dest='output_format', choices=['word2vec', 'container'],
+                        default='word2vec',
+                        help='Write one word2vec file per embedding variant, or all variants to a single container '
+                             'file PREFIXembeddings.emb (which export_word2vec.py converts to word2vec files)')
     parser.add_argument('--contexts', required=True, type=argparse.FileType('rb'),
                         help='Contexts, as generated from contexts.py')
+    parser.add_argument('--corpus-ids', dest='corpus_ids', type=str,
+                        help='File prefix of the binary processed corpus the contexts were sampled from; if given, '
+                             'the token ids of the contexts are read from it instead of parsing the context column')
     parser.add_argument('--vectorizations', type=str,
                         help='Comma-separated list of vectorizations to perform, or \'all\'', default='all')
     parser.add_argument('--poolings', type=str, help='Comma-separated list of poolings to perform, or \'all\'',
                         default='all')
     parser.add_argument('--aggregations', type=str, help='Comma-separated list of aggregations to perform, or \'all\'',
                         default='all')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to run the model on, e.g. cuda or cpu; defaults to cuda if available')
+    parser.add_argument('--threads', type=int, help='Number of intra-op threads for CPU inference')
+    parser.add_argument('--interop-threads', dest='interop_threads', type=int,
+                        help='Number of inter-op threads for CPU inference')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Dynamically quantize the linear layers of the model to int8 (CPU only)')
+    parser.add_argument('--bf16', action='store_true', help='Run the model under bfloat16 autocast (CPU only)')
+    parser.add_argument('--onnx', type=str,
+                        help='Run the model with ONNX Runtime (CPU only), from the ONNX graph at this path; if it does '
+                             'not exist, the model is exported to it first (with the hidden states needed for the '
+                             'requested vectorizations)')
+    parser.add_argument('--drift-words', dest='drift_words', type=int, default=0,
+                        help='With --quantize or --bf16, additionally embed the first N focus words with the fp32 '
+                             'model and report the cosine similarities of the resulting type vectors')
+    parser.add_argument('--token-budget', dest='token_budget', type=int, default=16384,
+                        help='Maximum number of (padded) tokens per batch')
+    parser.add_argument('--max-batch-size', dest='max_batch_size', type=int, default=256,
+                        help='Maximum number of contexts per batch')
+    parser.add_argument('--window', type=int, default=2000,
+                        help='Number of contexts (of consecutive focus words) to batch together')
+    parser.add_argument('--store-contexts', dest='store_contexts', type=str,
+                        help='File prefix of a store to keep the context embeddings (of all layers) of every word in, '
+                             'from which pool_contexts.py can generate type embeddings without the model')
+    parser.add_argument('--store-fp16', dest='store_fp16', action='store_true',
+                        help='Keep the context embeddings in the store as float16')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int, default=1024,
+                        help='Memory (in MiB) for intermediate results shared between the embedding variants of a word')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of embedder processes to run in parallel, on shards of the focus words (balanced '
+                             'by their numbers of contexts), each pinned to its share of the cores (or to one of '
+                             'several GPUs); their outputs are merged at the end')
+    parser.add_argument('--shard', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of windows to tokenize and pad ahead of the forward passes')
+    parser.add_argument('--write-queue', dest='write_queue', type=int, default=4,
+                        help='Maximum number of windows whose type vectors wait to be written')
     args = parser.parse_args()
     print(args, file=sys.stderr)
-
+    if (args.quantize or args.bf16) and not args.device.startswith('cpu'):
+        parser.error('--quantize and --bf16 are only supported on the CPU')
+    if args.quantize and args.bf16:
+        parser.error('--quantize and --bf16 cannot be combined')
+    if args.onnx is not None and (args.quantize or args.bf16 or not args.device.startswith('cpu')):
+        parser.error('--onnx runs on the CPU, and cannot be combined with --quantize or --bf16')
+    if args.bf16 and torch_version() < (1, 10):
+        parser.error(f"--bf16 requires bfloat16 autocast on the CPU, i.e. torch >= 1.10 (installed: "
+                     f"{torch.__version__}; requirements.txt pins 1.7, which suffices for everything else)")
+    if args.onnx is not None and torch_version() < (1, 7):
+        parser.error(f"--onnx requires the ONNX export of torch >= 1.7 (installed: {torch.__version__})")
+    if detect_compression(args.contexts) is not None:
+        parser.error('--contexts must be uncompressed, as it is read by seeking to the contexts of each word')
+    if args.workers > 1 and args.store_contexts is not None:
+        parser.error('--store-contexts cannot be combined with --workers')
     if args.vectorizations == 'all':
         vectorizations = AllSet()
     else:
@@ -109,55 +535,149 @@ if __name__ == '__main__':
     else:
         aggregations = args.aggregations.split(',')
 
+    # only compute the hidden states needed for the requested vectorizations (or all of them to be stored)
+    config = AutoConfig.from_pretrained(MODEL_NAME)
+    try:
+        layers = required_layers(vectorizations, config.num_hidden_layers + 1)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.workers > 1:
+        if args.onnx is not None:
+            # (exported once here, rather than by every worker)
+            ensure_onnx(args.onnx, layers)
+        run_workers(args, sys.argv[1:])
+        sys.exit(0)
+    shard, num_shards = map(int, args.shard.split('/')) if args.shard is not None else (0, 1)
+
     print(vectorizations, poolings, aggregations, file=sys.stderr, flush=True)
+    memory_budget = args.memory_budget << 20
 
-    tokenizer = BertTokenizer.from_pretrained("deepset/gbert-base")
+    tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
     tokenizer.do_basic_tokenize = False
 
-    model = AutoModel.from_pretrained("deepset/gbert-base")
-    model.eval()
-    model.to('cuda')
+    if args.shard is not None:
+        if args.device.startswith('cpu'):
+            pin_shard_threads(shard, num_shards, threads=args.threads)
+        elif args.device == 'cuda' and torch.cuda.device_count() > 1:
+            args.device = f"cuda:{shard % torch.cuda.device_count()}"
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads is not None:
+        torch.set_num_interop_threads(args.interop_threads)
+
+    if args.store_contexts is not None:
+        layers = required_layers(AllSet(), config.num_hidden_layers + 1)
+    print("using layers", layers, file=sys.stderr, flush=True)
+
+    if args.onnx is not None:
+        model = load_onnx_encoder(args.onnx, layers, threads=args.threads)
+    else:
+        model = load_model(args.device, quantize=args.quantize, bf16=args.bf16, num_layers=max(layers))
+    reference_model = None
+    drift = DriftReport()
+    if args.drift_words > 0 and (args.quantize or args.bf16):
+        reference_model = load_model(args.device, num_layers=max(layers))
     torch.no_grad()
     torch.set_grad_enabled(False)
 
     print("loading input", file=sys.stderr, flush=True)
-    input_contexts = pandas.read_csv(args.contexts, sep='\t', index_col=False, quoting=3)
-
-    vocab = list(input_contexts['token'].unique())
-    embeddings_files = dict()
-
-    with tqdm(total=len(input_contexts)) as pbar:
-        for focus_word, contexts in input_contexts.groupby('token'):
-            focus_len = contexts.iloc[0]['focus_len']
-
-            context_embeddings = torch.empty((len(contexts), focus_len, 13, 768)).cuda()
-            counter = 0
-
-            for chunk in [contexts.iloc[i:i + 20] for i in range(0, len(contexts), 20)]:
-                pieces = [x.split(' ') for x in chunk['context']]
-                focus_index = chunk['focus_index'].values
-
-                output, input_seq = forwardpass(pieces, model, tokenizer)
-                for j in range(len(chunk)):
-                    # adjust for added start token in sequence
-                    sl = slice(focus_index[j] + 1, focus_index[j] + 1 + focus_len)
-                    # assert tokenizer.convert_ids_to_tokens(list(input_seq[j][sl]))\
-                    #   == pieces[j][focus_index[j]:focus_index[j] + focus_len]
-                    # assert tokenizer.convert_tokens_to_string(tokenizer.convert_ids_to_tokens(list(input_seq[j][sl])))\
-                    #   == focus_word
-                    context_embeddings[counter] = output[j][sl].detach()
-                    counter += 1
-
-            for embedding_name, type_vector in generate_type_embeddings(context_embeddings,
-                                                                        vectorizations=vectorizations,
-                                                                        poolings=poolings, aggregations=aggregations):
-                if embedding_name not in embeddings_files.keys():
-                    embeddings_files[embedding_name] = open(args.output_prefix + embedding_name + '.bin', 'wb')
-                    embeddings_files[embedding_name].write(f"{len(vocab)} {type_vector.shape[0]}\n".encode('utf8'))
-                embeddings_files[embedding_name].write(f"{focus_word} ".encode('utf8') + np.array(type_vector.cpu()).astype(np.float32).tobytes())
-
-            del context_embeddings
-            pbar.update(len(contexts))
-
-    for ef in embeddings_files.values():
-        ef.close()
+    corpus = None
+    if args.corpus_ids is not None:
+        corpus = TokenCorpus(args.corpus_ids)
+        input_contexts = ContextReader(args.contexts, usecols=['token', 'focus_index', 'focus_len', 'line'])
+    else:
+        input_contexts = ContextReader(args.contexts)
+
+    # progress is journaled per window; a previous, interrupted run with the same settings is continued
+    journal = Journal(args.output_prefix + 'progress.journal', {
+        'contexts': os.path.abspath(args.contexts.name), 'corpus_ids': args.corpus_ids,
+        'vectorizations': args.vectorizations, 'poolings': args.poolings, 'aggregations': args.aggregations,
+        'quantize': args.quantize, 'bf16': args.bf16, 'output_format': args.output_format,
+        'store_contexts': args.store_contexts, 'store_fp16': args.store_fp16, 'shard': args.shard})
+    # the focus words of this shard, balanced by their numbers of contexts
+    words = input_contexts.words()
+    words = [words[i] for i in balanced_partition([input_contexts.count(word) for word in words], num_shards)[shard]]
+    if args.output_format == 'container':
+        output = ContainerWriter(args.output_prefix + 'embeddings.emb', words, journal=journal)
+    else:
+        output = Word2VecWriter(args.output_prefix, journal=journal)
+    store = None
+    if args.store_contexts is not None:
+        store = ContextStoreWriter(args.store_contexts, layers, config.hidden_size, fp16=args.store_fp16,
+                                   resume_words=journal.words)
+    completed = set(journal.words)
+    if len(completed) > 0:
+        print(f"resuming after {len(completed)} completed words", file=sys.stderr, flush=True)
+
+    # Three stages: a background thread tokenizes and pads the next windows (into pinned memory if the
+    # model runs on the GPU), the main thread runs the model, pooling and aggregation, and another
+    # background thread writes the type vectors. All queues are bounded.
+    prepared_windows = background_iter(
+        (WindowBatches(window, tokenizer, corpus=corpus, token_budget=args.token_budget,
+                       max_batch_size=args.max_batch_size, pin_memory=args.device.startswith('cuda'))
+         for window in word_windows(input_contexts.groups(words, skip=completed), args.window)),
+        queue_size=args.prefetch)
+
+    def write_window(window_type_embeddings, window_context_embeddings):
+        # the store is synced before the output journals the words as completed
+        if store is not None:
+            store.write_words(window_context_embeddings)
+        output.write_words(window_type_embeddings)
+
+    writer = BackgroundWorker(write_window, queue_size=args.write_queue)
+
+    padding_stats = PaddingStats()
+    dedup_stats = DedupStats()
+    word_no = 0
+    with tqdm(total=sum(input_contexts.count(word) for word in words),
+              initial=sum(input_contexts.count(word) for word in completed), position=shard) as pbar:
+        for window_batches in prepared_windows:
+            window = window_batches.words
+            window_embeddings = window_batches.embed(model, layers, device=args.device, padding_stats=padding_stats,
+                                                     dedup_stats=dedup_stats)
+            reference_words = window[:max(args.drift_words - word_no, 0)] if reference_model is not None else []
+            reference_embeddings = embed_words(reference_words, reference_model, tokenizer, layers, corpus=corpus,
+                                               device=args.device, token_budget=args.token_budget,
+                                               max_batch_size=args.max_batch_size)
+
+            window_type_embeddings = []
+            window_context_embeddings = []
+            for w, ((focus_word, contexts), context_embeddings) in enumerate(zip(window, window_embeddings)):
+                type_embeddings = list(generate_type_embeddings(context_embeddings, vectorizations=vectorizations,
+                                                                poolings=poolings, aggregations=aggregations,
+                                                                layers=layers, memory_budget=memory_budget))
+                if w < len(reference_embeddings):
+                    for (embedding_name, type_vector), (_, reference_vector) in zip(
+                            type_embeddings, generate_type_embeddings(reference_embeddings[w],
+                                                                      vectorizations=vectorizations,
+                                                                      poolings=poolings, aggregations=aggregations,
+                                                                      layers=layers, memory_budget=memory_budget)):
+                        drift.add(embedding_name, type_vector, reference_vector)
+
+                window_type_embeddings.append((focus_word, [(embedding_name, type_vector.cpu().numpy())
+                                                            for embedding_name, type_vector in type_embeddings]))
+                if store is not None:
+                    stored = context_embeddings.half() if args.store_fp16 else context_embeddings
+                    window_context_embeddings.append((focus_word, stored.cpu().numpy()))
+                pbar.update(len(contexts))
+                word_no += 1
+
+            writer.submit(window_type_embeddings, window_context_embeddings)
+
+            del window_batches, window_embeddings, reference_embeddings
+
+    writer.close()
+    output.finalize()
+    if store is not None:
+        store.close()
+    if args.shard is not None:
+        # marks the shard as complete for the launcher, listing its words in the order they were written (moved
+        # into place once complete)
+        with open(args.output_prefix + 'done.tmp', 'w', encoding='utf8') as f:
+            for word in words:
+                print(word, file=f)
+        os.replace(args.output_prefix + 'done.tmp', args.output_prefix + 'done')
+    print(padding_stats, file=sys.stderr)
+    print(dedup_stats, file=sys.stderr)
+    drift.print()
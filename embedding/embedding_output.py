@@ -0,0 +1,305 @@
+import json
+import os
+
+import numpy as np
+
+# the word2vec header is written with a placeholder count first, padded to a fixed width so that it can be
+# rewritten in place once the number of words is known
+HEADER_WIDTH = 32
+
+
+def format_header(num_words, dim):
+    header = f"{num_words} {dim}"
+    assert len(header) < HEADER_WIDTH
+    return (header.ljust(HEADER_WIDTH - 1) + '\n').encode('utf8')
+
+
+def read_header(path):
+    # the number of words and the dimension of a word2vec file
+    with open(path, 'rb') as f:
+        num_words, dim = f.readline().split()
+    return int(num_words), int(dim)
+
+
+def word2vec_files(prefix):
+    # the word2vec files PREFIX<embedding name>.bin, by embedding name
+    directory, prefix = os.path.split(prefix)
+    return {filename[len(prefix):-len('.bin')]: os.path.join(directory, filename)
+            for filename in sorted(os.listdir(directory or '.'))
+            if filename.startswith(prefix) and filename.endswith('.bin')}
+
+
+def merge_word2vec(shard_prefixes, shard_words, words, prefix):
+    # merges the word2vec files of several shards (as written by Word2VecWriter) per embedding variant, with the
+    # records in the given order of all words; shard_words are the words of every shard, in the order written
+    shard_of = {word: i for i, words_of_shard in enumerate(shard_words) for word in words_of_shard}
+    shard_files = [word2vec_files(shard_prefix) for shard_prefix in shard_prefixes]
+    for embedding_name in sorted({name for files in shard_files for name in files}):
+        paths = {i: files[embedding_name] for i, files in enumerate(shard_files) if embedding_name in files}
+        headers = {i: read_header(path) for i, path in paths.items()}
+        assert len({dim for _, dim in headers.values()}) == 1, f"shards of {embedding_name} differ in dimension"
+        assert all(num_words == len(shard_words[i]) for i, (num_words, _) in headers.items()), \
+            f"shards of {embedding_name} do not match their word lists"
+        dim = next(iter(headers.values()))[1]
+        inputs = {i: open(path, 'rb', buffering=1 << 20) for i, path in paths.items()}
+        for f in inputs.values():
+            f.seek(HEADER_WIDTH)
+        with open(prefix + embedding_name + '.bin', 'wb', buffering=1 << 20) as out:
+            out.write(f"{len(words)} {dim}\n".encode('utf8'))
+            for word in words:
+                out.write(inputs[shard_of[word]].read(record_size(word, dim)))
+        for f in inputs.values():
+            f.close()
+
+
+def record_size(word, dim):
+    return len(word.encode('utf8')) + 1 + 4 * dim
+
+
+class Journal:
+    # Progress journal of a run: the first line holds the settings of the run, the second the output variants as
+    # a JSON list of [embedding name, dimension] (written before the first word), every further line a focus word
+    # whose type vectors have been completely written to all output files.
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.variants = None
+        self.words = []
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as f:
+                lines = f.read().split('\n')
+            if json.loads(lines[0]) != settings:
+                raise ValueError(f"{path} belongs to a run with different settings ({lines[0]}); remove it to "
+                                 f"start over")
+            # a trailing line without newline was interrupted while writing
+            complete = lines[:-1]
+            if len(complete) > 1:
+                self.variants = [(embedding_name, dim) for embedding_name, dim in json.loads(complete[1])]
+                self.words = complete[2:]
+            self._file = open(path, 'r+', encoding='utf8')
+            self._file.truncate(sum(len(line.encode('utf8')) + 1 for line in complete))
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, 'w', encoding='utf8')
+            print(json.dumps(settings), file=self._file, flush=True)
+
+    def set_variants(self, variants):
+        # records the (embedding name, dimension) of the output variants, once they are known
+        assert self.variants is None
+        self.variants = [(embedding_name, int(dim)) for embedding_name, dim in variants]
+        print(json.dumps(self.variants), file=self._file)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, words):
+        assert self.variants is not None, "the variants must be recorded before the first word"
+        for word in words:
+            print(word, file=self._file)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.words.extend(words)
+
+    def remove(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class Word2VecWriter:
+    # Writes one binary word2vec file per embedding variant, appending vectors as they come. With a
+    # journal, the output of a previous, interrupted run is cut back to the journaled words and continued.
+
+    def __init__(self, prefix, journal=None):
+        self.prefix = prefix
+        self.journal = journal
+        self.files = dict()
+        self.dims = dict()
+        self.num_words = 0
+        if journal is not None and len(journal.words) > 0:
+            self._resume(journal.words)
+
+    def _path(self, embedding_name):
+        return self.prefix + embedding_name + '.bin'
+
+    def _resume(self, words):
+        # only the files of the journaled variants are continued, other files with the same prefix are left alone
+        for embedding_name, dim in self.journal.variants:
+            path = self._path(embedding_name)
+            size = HEADER_WIDTH + sum(record_size(word, dim) for word in words)
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                raise ValueError(f"{path} is missing or shorter than its journal says")
+            # drop everything written after the last journaled word
+            os.truncate(path, size)
+            self.files[embedding_name] = open(path, 'ab')
+            self.dims[embedding_name] = dim
+        self.num_words = len(words)
+
+    def write(self, focus_word, type_embeddings):
+        for embedding_name, type_vector in type_embeddings:
+            if embedding_name not in self.files:
+                assert self.num_words == 0, f"new embedding variant {embedding_name} after the first word"
+                self.files[embedding_name] = open(self._path(embedding_name), 'wb')
+                self.files[embedding_name].write(format_header(0, type_vector.shape[0]))
+                self.dims[embedding_name] = type_vector.shape[0]
+            self.files[embedding_name].write(
+                f"{focus_word} ".encode('utf8') + type_vector.astype(np.float32).tobytes())
+        self.num_words += 1
+
+    def write_words(self, words):
+        # writes the type embeddings of several (focus_word, type_embeddings), then records them as completed
+        for focus_word, type_embeddings in words:
+            self.write(focus_word, type_embeddings)
+        if self.journal is not None:
+            for f in self.files.values():
+                f.flush()
+                os.fsync(f.fileno())
+            if self.journal.variants is None:
+                self.journal.set_variants(self.dims.items())
+            self.journal.add([focus_word for focus_word, _ in words])
+
+    def finalize(self):
+        # closes all files, writing the final word counts into their headers
+        for embedding_name, f in self.files.items():
+            f.close()
+            with open(self._path(embedding_name), 'r+b') as f:
+                f.write(format_header(self.num_words, self.dims[embedding_name]))
+        if self.journal is not None:
+            self.journal.remove()
+
+
+# A container holds all embedding variants of a run in one file: a magic string, the length of the header, the
+# header (JSON: the vocabulary, and the name, dimension and byte offset of every variant), and then one
+# contiguous, memory-mappable float32 matrix (words x dimension) per variant.
+CONTAINER_MAGIC = b'EMBEDS01'
+CONTAINER_ALIGNMENT = 64
+
+
+def _read_container_header(f):
+    f.seek(0)
+    if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+        raise ValueError(f"{f.name} is not an embedding container")
+    header_len = int.from_bytes(f.read(8), 'little')
+    return json.loads(f.read(header_len).decode('utf8')), header_len
+
+
+class ContainerWriter:
+    # Writes all embedding variants to a single container file. The vocabulary (the focus words, in the order
+    # they are processed) must be known up front; the layout is fixed once the first word gives the variants
+    # and their dimensions. With a journal, the container of a previous, interrupted run is continued.
+
+    def __init__(self, path, words, journal=None):
+        self.path = path
+        self.words = list(words)
+        self.row = {word: i for i, word in enumerate(self.words)}
+        self.journal = journal
+        self.file = None
+        self.header = None
+        self.header_len = None
+        if journal is not None and len(journal.words) > 0:
+            self.file = open(path, 'r+b')
+            self.header, self.header_len = _read_container_header(self.file)
+            if self.header['words'] != self.words:
+                raise ValueError(f"{path} was written for a different vocabulary")
+
+    def _write_header(self):
+        header = json.dumps(self.header).encode('utf8')
+        assert len(header) <= self.header_len
+        self.file.seek(0)
+        self.file.write(CONTAINER_MAGIC + self.header_len.to_bytes(8, 'little') + header.ljust(self.header_len))
+
+    def create(self, dims):
+        # fixes the layout for the given (embedding name, dimension) of all variants
+        self.header = {'words': self.words, 'complete': False,
+                       'variants': [{'name': embedding_name, 'dim': int(dim), 'offset': 0}
+                                    for embedding_name, dim in dims]}
+        # reserve room for the offsets (up to 20 digits each) and the final 'complete' flag
+        self.header_len = len(json.dumps(self.header).encode('utf8')) + 20 * len(self.header['variants']) + 1
+        offset = len(CONTAINER_MAGIC) + 8 + self.header_len
+        for variant in self.header['variants']:
+            offset = -(-offset // CONTAINER_ALIGNMENT) * CONTAINER_ALIGNMENT
+            variant['offset'] = offset
+            offset += 4 * variant['dim'] * len(self.words)
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(offset)
+        self._write_header()
+
+    def write_words(self, words):
+        # writes the type embeddings of several consecutive (focus_word, type_embeddings), then records them
+        # as completed
+        if self.file is None:
+            self.create([(embedding_name, type_vector.shape[0]) for embedding_name, type_vector in words[0][1]])
+        first = self.row[words[0][0]]
+        assert [self.row[focus_word] for focus_word, _ in words] == list(range(first, first + len(words)))
+        blocks = []
+        for i, variant in enumerate(self.header['variants']):
+            assert all(type_embeddings[i][0] == variant['name'] for _, type_embeddings in words)
+            blocks.append(np.stack([type_embeddings[i][1] for _, type_embeddings in words]))
+        self.write_rows(first, blocks)
+        if self.journal is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.journal.variants is None:
+                self.journal.set_variants([(variant['name'], variant['dim']) for variant in self.header['variants']])
+            self.journal.add([focus_word for focus_word, _ in words])
+
+    def write_rows(self, first, blocks):
+        # writes one block of consecutive rows, starting at row first, per variant
+        for variant, block in zip(self.header['variants'], blocks):
+            self.file.seek(variant['offset'] + 4 * variant['dim'] * first)
+            self.file.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+
+    def finalize(self):
+        if self.file is not None:
+            self.header['complete'] = True
+            self._write_header()
+            self.file.close()
+        if self.journal is not None:
+            self.journal.remove()
+
+
+class EmbeddingContainer:
+    # read access to a container, with every variant memory-mapped as a words x dimension float32 array
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header, _ = _read_container_header(f)
+        self.words = header['words']
+        self.complete = header['complete']
+        self.variants = {variant['name']: np.memmap(path, dtype='<f4', mode='r', offset=variant['offset'],
+                                                    shape=(len(self.words), variant['dim']))
+                         for variant in header['variants']}
+
+    def __getitem__(self, embedding_name):
+        return self.variants[embedding_name]
+
+
+def write_word2vec(path, words, vectors):
+    with open(path, 'wb') as f:
+        f.write(f"{len(words)} {vectors.shape[1]}\n".encode('utf8'))
+        for word, vector in zip(words, vectors):
+            f.write(f"{word} ".encode('utf8') + np.asarray(vector, dtype=np.float32).tobytes())
+
+
+def merge_containers(paths, path, words, block_size=4096):
+    # merges the containers of several shards (vocabularies and matrices of all variants), with the rows in the
+    # given order of all words; without any shard container (no shard had words), nothing is written
+    if len(paths) == 0:
+        return
+    shards = [EmbeddingContainer(p) for p in paths]
+    location = {word: (i, row) for i, shard in enumerate(shards) for row, word in enumerate(shard.words)}
+    assert sorted(location) == sorted(words), "the shard containers do not match the words"
+    writer = ContainerWriter(path, words)
+    writer.create([(embedding_name, matrix.shape[1]) for embedding_name, matrix in shards[0].variants.items()])
+    for shard in shards:
+        assert list(shard.variants) == list(shards[0].variants), f"{shard.path} has different variants"
+    for start in range(0, len(words), block_size):
+        shard_ids, rows = map(np.array, zip(*(location[word] for word in words[start:start + block_size])))
+        blocks = []
+        for embedding_name, matrix in shards[0].variants.items():
+            block = np.empty((len(rows), matrix.shape[1]), dtype=np.float32)
+            for i, shard in enumerate(shards):
+                block[shard_ids == i] = shard[embedding_name][rows[shard_ids == i]]
+            blocks.append(block)
+        writer.write_rows(start, blocks)
+    writer.finalize()
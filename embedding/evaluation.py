@@ -1,94 +1,123 @@
 import argparse
-import itertools
+import multiprocessing
+import os
 import sys
 
 import gensim.models.keyedvectors
 import numpy as np
 import pandas
 import torch
-from scipy.spatial.distance import cosine
 from scipy.stats import spearmanr
 from sklearn.metrics import f1_score
 
 
-def eval_men(embedding, men_pairs):
-    left, right, scores = zip(*men_pairs)
-    scores = -np.array(scores).astype(float)
-    left_vectors = embedding[left]
-    right_vectors = embedding[right]
+def cosine_distances(left_vectors, right_vectors):
+    # the cosine distances between corresponding vectors (along the last axis, broadcast over the leading ones), as
+    # computed by scipy.spatial.distance.cosine (clipped to [0, 2], nan for zero vectors)
+    uv = np.einsum('...i,...i->...', left_vectors, right_vectors)
+    uu = np.einsum('...i,...i->...', left_vectors, left_vectors)
+    vv = np.einsum('...i,...i->...', right_vectors, right_vectors)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(1 - uv / np.sqrt(uu * vv), 0, 2)
 
-    return spearmanr(scores, [cosine(*pair) for pair in zip(left_vectors, right_vectors)])[0]
 
+# the datasets of a testsets file, each with its kind of evaluation
+DATASETS = [('men', 'similarity'), ('simlex', 'similarity'), ('schm280', 'similarity'), ('toefl', 'prompts'),
+            ('duden', 'prompts'), ('wiktionary', 'relations'), ('germanet', 'relations')]
+WORD_COLUMNS = ['0', '1', '2', '3', '4', '5']
 
-def eval_toefl(embedding, toefl_prompts):
-    toefl_prompts = np.array(toefl_prompts)
-    vectors = embedding[toefl_prompts.reshape(-1)].reshape(*toefl_prompts.shape, -1)
 
-    return np.array(
-        [np.array([cosine(prompt[0], prompt[i]) for i in range(1, 5)]).argmin() == 0 for prompt in vectors]).mean()
+def similarity_score(left_vectors, right_vectors, scores):
+    # Spearman correlation of the cosine similarities of the pairs and their scores
+    return spearmanr(-np.asarray(scores, dtype=float), cosine_distances(left_vectors, right_vectors))[0]
 
 
-def eval_nearest_center_classification(embedding, pairs):
-    labels = []
-    directions = []
-    sorted_pairs = np.array(sorted(list(pairs), key=lambda x: x[-1]))
-    y_true = []
-    i = 0
-    for k, g in itertools.groupby(sorted_pairs, key=lambda x: x[-1]):
-        left, right, _ = zip(*g)
+def prompt_accuracy(vectors):
+    # vectors: prompts x 5 x dimension, the prompt word first; correct if the first of the candidates is the closest
+    # to the prompt word
+    return (cosine_distances(vectors[:, :1], vectors[:, 1:]).argmin(axis=1) == 0).mean()
 
-        left_vectors = embedding[left]
-        right_vectors = embedding[right]
-        directions.append(right_vectors - left_vectors)
-        y_true.append(np.array(len(left_vectors) * [i]))
-        labels.append(k)
-        i += 1
 
-    directions = torch.tensor(np.concatenate(directions)).cuda()
-    y_true = torch.tensor(np.concatenate(y_true))
+def nearest_center_f1(directions, y_true, device='cpu'):
+    # macro F1 of classifying the relation directions by the nearest (l1) class median; y_true are the classes
+    # 0, ..., k - 1
+    directions = torch.tensor(directions).to(device)
+    y_true = torch.tensor(y_true)
 
-    representants = torch.stack([directions[y_true == i].quantile(axis=0, q=0.5) for i in range(y_true[-1] + 1)])
+    representants = torch.stack([directions[y_true == i].quantile(dim=0, q=0.5) for i in range(y_true.max() + 1)])
     y_pred = torch.cdist(representants, directions, p=1).argmin(dim=0).cpu()
-    macro_f1 = f1_score(y_true, y_pred, average='macro')
-    return macro_f1
+    return f1_score(y_true, y_pred, average='macro')
 
 
-def evaluate(embedding, efname, testsets, out):
-    oov_words = {x for x in testsets[['0', '1', '2', '3', '4', '5']].values.reshape(-1) if x not in embedding} - {
-        np.nan}
+def eval_men(embedding, men_pairs):
+    left, right, scores = zip(*men_pairs)
+    vectors = np.asarray(embedding[list(left) + list(right)], dtype=np.float64)
+
+    return similarity_score(vectors[:len(left)], vectors[len(left):], scores)
 
-    missing = testsets.loc[:, ['0', '1', '2', '3', '4', '5']].apply(
-        lambda r: not all(pandas.isna(w) or w not in oov_words for w in r.values), axis=1)
 
-    testsets = testsets[~missing]
-    if len(oov_words) > 0:
-        print(f"WARN: {len(oov_words)} OOV words for {efname}, removing {missing.sum()} evaluation entries",
+def eval_toefl(embedding, toefl_prompts):
+    toefl_prompts = np.array(toefl_prompts)
+    vectors = np.asarray(embedding[toefl_prompts.reshape(-1)], dtype=np.float64).reshape(*toefl_prompts.shape, -1)
+
+    return prompt_accuracy(vectors)
+
+
+def eval_nearest_center_classification(embedding, pairs, device='cpu'):
+    left, right, relations = zip(*pairs)
+    # the classes are numbered in sorted order of the relations
+    _, y_true = np.unique(np.array(relations, dtype=str), return_inverse=True)
+
+    return nearest_center_f1(embedding[list(right)] - embedding[list(left)], y_true, device=device)
+
+
+def compile_testsets(testsets):
+    # The testsets as indices into one shared, sorted list of their words: per dataset, the indices of the words
+    # of its entries (entries x 6, -1 where empty) and the values of its entries. This is done once, and every
+    # embedding only needs to be looked up for the words of the list.
+    cells = testsets[WORD_COLUMNS].values
+    present = ~pandas.isna(cells)
+    words, inverse = np.unique(cells[present].astype(str), return_inverse=True)
+    indices = np.full(cells.shape, -1, dtype=np.int64)
+    indices[present] = inverse
+    datasets = []
+    for dataset, kind in DATASETS:
+        rows = (testsets['dataset'] == dataset).values
+        datasets.append((dataset, kind, indices[rows], testsets['value'].values[rows]))
+    return list(words), datasets
+
+
+def evaluate(embedding, efname, words, datasets, device='cpu'):
+    # the (dataset, score) of the embedding for the compiled testsets (cf. compile_testsets), leaving out the
+    # entries with words missing from the embedding
+    in_vocab = np.array([word in embedding for word in words], dtype=bool)
+    vectors = np.zeros((len(words), embedding.vector_size), dtype=np.float32)
+    if in_vocab.any():
+        vectors[in_vocab] = embedding[[word for word, known in zip(words, in_vocab) if known]]
+
+    known_entries = [np.all((indices < 0) | in_vocab[indices], axis=1) for _, _, indices, _ in datasets]
+    if not in_vocab.all():
+        oov_words = [word for word, known in zip(words, in_vocab) if not known]
+        num_missing = sum(int((~known).sum()) for known in known_entries)
+        print(f"WARN: {len(oov_words)} OOV words for {efname}, removing {num_missing} evaluation entries",
               file=sys.stderr)
         print(f"({', '.join(oov_words)})", file=sys.stderr)
 
-    # MEN
-    men_pairs = list(map(tuple, testsets[testsets['dataset'] == 'men'][['0', '1', 'value']].values))
-    print(efname, 'men', eval_men(embedding, men_pairs), sep='\t', file=out, flush=True)
-    # Simlex
-    simlex_pairs = list(map(tuple, testsets[testsets['dataset'] == 'simlex'][['0', '1', 'value']].values))
-    print(efname, 'simlex', eval_men(embedding, simlex_pairs), sep='\t', file=out, flush=True)
-    # Schm
-    schm_pairs = list(map(tuple, testsets[testsets['dataset'] == 'schm280'][['0', '1', 'value']].values))
-    print(efname, 'schm280', eval_men(embedding, schm_pairs), sep='\t', file=out, flush=True)
-    # toefl
-    toefl_prompts = list(map(tuple, testsets[testsets['dataset'] == 'toefl'][['0', '1', '2', '3', '4']].values))
-    print(efname, 'toefl', eval_toefl(embedding, toefl_prompts), sep='\t', file=out, flush=True)
-    # duden
-    duden_prompts = list(map(tuple, testsets[testsets['dataset'] == 'duden'][['0', '1', '2', '3', '4']].values))
-    print(efname, 'duden', eval_toefl(embedding, duden_prompts), sep='\t', file=out, flush=True)
-    # wiktionary
-    wiktionary_relations = list(map(tuple, testsets[testsets['dataset'] == 'wiktionary'][['0', '1', 'value']].values))
-    print(efname, 'wiktionary', eval_nearest_center_classification(embedding, wiktionary_relations), sep='\t', file=out,
-          flush=True)
-    # germanet
-    germanet_relations = list(map(tuple, testsets[testsets['dataset'] == 'germanet'][['0', '1', 'value']].values))
-    print(efname, 'germanet', eval_nearest_center_classification(embedding, germanet_relations), sep='\t', file=out,
-          flush=True)
+    results = []
+    for (dataset, kind, indices, values), known in zip(datasets, known_entries):
+        indices, values = indices[known], values[known]
+        if len(indices) == 0:
+            results.append((dataset, np.nan))
+        elif kind == 'similarity':
+            results.append((dataset, similarity_score(vectors[indices[:, 0]].astype(np.float64),
+                                                      vectors[indices[:, 1]].astype(np.float64), values)))
+        elif kind == 'prompts':
+            results.append((dataset, prompt_accuracy(vectors[indices[:, :5]].astype(np.float64))))
+        elif kind == 'relations':
+            _, y_true = np.unique(values.astype(str), return_inverse=True)
+            results.append((dataset, nearest_center_f1(vectors[indices[:, 1]] - vectors[indices[:, 0]], y_true,
+                                                       device=device)))
+    return results
 
 
 def load_embedding(efname):
@@ -106,6 +135,35 @@ def load_embedding(efname):
     return gensim.models.keyedvectors.KeyedVectors.load_word2vec_format(efname, binary=False, no_header=True)
 
 
+_worker_state = None
+
+
+def _init_worker(words, datasets, device, threads=None):
+    global _worker_state
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _worker_state = words, datasets, device
+
+
+def evaluate_file(efname):
+    words, datasets, device = _worker_state
+    return evaluate(load_embedding(efname), efname, words, datasets, device=device)
+
+
+def evaluate_files(efnames, words, datasets, device='cpu', num_workers=1):
+    # yields the results of evaluate for the given embedding files, in their order; with several workers, each
+    # evaluates whole files, with its share of the cores
+    if num_workers > 1:
+        # (spawned rather than forked, so that the workers can use CUDA)
+        context = multiprocessing.get_context('spawn')
+        threads = max(1, os.cpu_count() // num_workers)
+        with context.Pool(num_workers, initializer=_init_worker, initargs=(words, datasets, device, threads)) as pool:
+            yield from pool.imap(evaluate_file, efnames)
+    else:
+        _init_worker(words, datasets, device)
+        yield from map(evaluate_file, efnames)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
@@ -113,13 +171,20 @@ if __name__ == '__main__':
                         default=sys.stdout)
     parser.add_argument('--testsets', required=True, type=argparse.FileType('r'),
                         help='Testset file, as generated by generate_testsets.py', default=sys.stdout)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to evaluate the embeddings with; the results are written in the '
+                             'order of the embedding arguments')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device for the nearest center classification, e.g. cuda or cpu; defaults to cuda if '
+                             'available')
     parser.add_argument('embedding', nargs='+', type=str, help="Embedding file, in word2vec binary format")
     args = parser.parse_args()
 
     testsets = pandas.read_csv(args.testsets, sep='\t')
     args.testsets.close()
+    words, datasets = compile_testsets(testsets)
 
-    for efname in args.embedding:
-        embedding = load_embedding(efname)
-
-        evaluate(embedding, efname, testsets, args.output)
+    for efname, scores in zip(args.embedding, evaluate_files(args.embedding, words, datasets, device=args.device,
+                                                             num_workers=args.workers)):
+        for dataset, score in scores:
+            print(efname, dataset, score, sep='\t', file=args.output, flush=True)
@@ -0,0 +1,29 @@
+import argparse
+import sys
+
+from tqdm import tqdm
+
+from embedding_output import EmbeddingContainer, write_word2vec
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Exports the embedding variants of a container, as written by embedder.py with '
+                    '--output-format container, to binary word2vec files')
+    parser.add_argument('--container', type=str, required=True, help='Container file to export')
+    parser.add_argument('--output-prefix', dest='output_prefix', type=str, required=True,
+                        help='File prefix for the word2vec files (PREFIX<variant>.bin)')
+    parser.add_argument('--variants', type=str, default='all',
+                        help='Comma-separated list of embedding variants to export, or \'all\'')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+
+    container = EmbeddingContainer(args.container)
+    if not container.complete:
+        parser.error(f"{args.container} is incomplete; resume the embedder run first")
+    variants = list(container.variants) if args.variants == 'all' else args.variants.split(',')
+    for embedding_name in variants:
+        if embedding_name not in container.variants:
+            parser.error(f"no variant {embedding_name} in {args.container}")
+
+    for embedding_name in tqdm(variants):
+        write_word2vec(args.output_prefix + embedding_name + '.bin', container.words, container[embedding_name])
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+from tqdm import tqdm
+
+from compressed_io import detect_compression
+from contexts import batches, build_query_word_trie, match_batch
+from occurrence_index import POSTING_DTYPE, STARTS_DTYPE, corpus_meta
+from token_corpus import TokenCorpus
+
+RECORD_DTYPE = np.dtype([('word', '<u4')] + POSTING_DTYPE.descr)
+
+
+def offset_line_iter(corpus_file):
+    # yields the byte offset and the wordpieces of every line
+    offset = 0
+    with tqdm(unit='B', unit_scale=True, total=os.path.getsize(corpus_file.name)) as pbar:
+        for line in corpus_file:
+            pbar.update(len(line))
+            yield offset, line.decode('utf-8').strip().split()
+            offset += len(line)
+
+
+def ids_offset_line_iter(corpus):
+    for line_no, line in enumerate(tqdm(corpus.lines(), total=len(corpus), unit='lines', unit_scale=True)):
+        yield line_no, line
+
+
+def build_index(lines, words, counts, prefix, meta, as_ids=False, num_buckets=64, tmp_dir=None, flush_size=1_000_000,
+                batch_size=1000):
+    # Occurrences are first distributed to num_buckets temporary files by contiguous ranges of word ids
+    # (balanced by the word frequencies), then every bucket is sorted by word id in memory and appended to
+    # the postings file. Hence, peak memory is about 1 / num_buckets of the (uncompressed) index.
+    trie = build_query_word_trie(words)
+
+    counts = np.asarray(counts, dtype=np.float64)
+    bucket_of_word = np.minimum((np.cumsum(counts) - counts) * num_buckets // max(counts.sum(), 1),
+                                num_buckets - 1).astype(np.int64)
+
+    tmp_dir = tempfile.mkdtemp(prefix='index-', dir=tmp_dir)
+    bucket_paths = [os.path.join(tmp_dir, f"bucket{b}") for b in range(num_buckets)]
+    bucket_files = [open(path, 'wb') for path in bucket_paths]
+    buffers = [[] for _ in range(num_buckets)]
+    buffered = np.zeros(num_buckets, dtype=np.int64)
+
+    def flush(b):
+        for matches in buffers[b]:
+            matches.tofile(bucket_files[b])
+        buffers[b] = []
+        buffered[b] = 0
+
+    line_no = 0
+    for batch in batches(lines, batch_size):
+        offsets, batch_lines = zip(*batch)
+        i, matches_word, matches_index, matches_length = match_batch(trie, batch_lines, as_ids)
+        matches = np.empty(len(i), dtype=RECORD_DTYPE)
+        matches['word'] = matches_word
+        matches['line'] = line_no + i
+        matches['offset'] = np.asarray(offsets, dtype=np.uint64)[i]
+        matches['index'] = matches_index
+        matches['length'] = matches_length
+        line_no += len(batch)
+
+        match_buckets = bucket_of_word[matches_word]
+        for b in np.unique(match_buckets):
+            buffers[b].append(matches[match_buckets == b])
+            buffered[b] += len(buffers[b][-1])
+            if buffered[b] >= flush_size:
+                flush(b)
+
+    for b in range(num_buckets):
+        flush(b)
+        bucket_files[b].close()
+
+    with open(prefix + '.words', 'w', encoding='utf-8') as f:
+        for word in words:
+            print(word, file=f)
+
+    occurrences_per_word = np.zeros(len(words), dtype=np.int64)
+    with open(prefix + '.postings', 'wb') as postings_file:
+        for path in tqdm(bucket_paths, desc='sorting'):
+            records = np.fromfile(path, dtype=RECORD_DTYPE)
+            os.remove(path)
+            # stable sort, keeping the occurrences of each word in corpus order
+            records = records[np.argsort(records['word'], kind='stable')]
+            occurrences_per_word += np.bincount(records['word'], minlength=len(words))
+            postings = np.empty(len(records), dtype=POSTING_DTYPE)
+            for field in POSTING_DTYPE.names:
+                postings[field] = records[field]
+            postings.tofile(postings_file)
+    os.rmdir(tmp_dir)
+
+    starts = np.zeros(len(words) + 1, dtype=STARTS_DTYPE)
+    np.cumsum(occurrences_per_word, out=starts[1:])
+    starts.tofile(prefix + '.starts')
+    with open(prefix + '.meta', 'w', encoding='utf8') as f:
+        json.dump(meta, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Builds an index of all occurrences of all vocabulary words in a processed corpus, from which '
+                    'contexts.py can sample contexts without scanning the corpus')
+    parser.add_argument('--output', type=str, required=True,
+                        help='File prefix to write the index to (PREFIX.words, PREFIX.postings, PREFIX.starts, '
+                             'PREFIX.meta)')
+    parser.add_argument('--vocab', type=argparse.FileType('r'), required=True,
+                        help='Vocabulary file corresponding to the corpus file, as generated from corpus_tokenizer.py')
+    corpus_group = parser.add_mutually_exclusive_group(required=True)
+    corpus_group.add_argument('--corpus', type=argparse.FileType('rb'),
+                              help='Processed corpus file, as generated from corpus_tokenizer.py')
+    corpus_group.add_argument('--corpus-ids', dest='corpus_ids', type=str,
+                              help='File prefix of a binary processed corpus, as generated from corpus_tokenizer.py '
+                                   'with --ids-output')
+    parser.add_argument('--min-count', dest='min_count', type=int, default=1,
+                        help='Only index vocabulary words with at least this frequency')
+    parser.add_argument('--buckets', type=int, default=64,
+                        help='Number of temporary buckets; peak memory is about the index size divided by this')
+    parser.add_argument('--tmp-dir', dest='tmp_dir', type=str, help='Directory for temporary buckets')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+    if args.corpus is not None and detect_compression(args.corpus) is not None:
+        parser.error('--corpus must be uncompressed, as the index records byte offsets into it')
+
+    print("loading vocabulary", file=sys.stderr, flush=True)
+    words, counts = [], []
+    for line in args.vocab:
+        word, count = line.strip().split(' ')
+        if int(count) >= args.min_count:
+            words.append(word)
+            counts.append(int(count))
+    args.vocab.close()
+
+    if args.corpus_ids is not None:
+        lines = ids_offset_line_iter(TokenCorpus(args.corpus_ids))
+    else:
+        lines = offset_line_iter(args.corpus)
+    meta = corpus_meta(corpus_path=args.corpus.name if args.corpus is not None else None, corpus_ids=args.corpus_ids)
+    build_index(lines, words, counts, args.output, meta, as_ids=args.corpus_ids is not None, num_buckets=args.buckets,
+                tmp_dir=args.tmp_dir)
+
+    if args.corpus is not None:
+        args.corpus.close()
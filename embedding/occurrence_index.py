@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+from token_corpus import memmap_file
+
+# An occurrence index of a processed corpus consists of four files:
+#   PREFIX.words     the indexed words, one per line, in the order of their word ids
+#   PREFIX.postings  all occurrences, grouped by word id and in corpus order within each word
+#   PREFIX.starts    uint64 offsets into PREFIX.postings; word i spans postings[starts[i]:starts[i + 1]]
+#   PREFIX.meta      the kind ('text' or 'ids') and size of the indexed corpus, cf. corpus_meta
+# For each occurrence, 'line' is the line number in the corpus, 'offset' the byte offset of the line in
+# a text corpus (or again the line number in a binary corpus), and 'index' and 'length' the position of
+# the word's wordpieces within the line.
+POSTING_DTYPE = np.dtype([('line', '<u8'), ('offset', '<u8'), ('index', '<u2'), ('length', '<u2')])
+STARTS_DTYPE = np.dtype('<u8')
+
+
+def corpus_meta(corpus_path=None, corpus_ids=None):
+    # the kind of a corpus and its size in bytes (of PREFIX.ids for a binary corpus), to tell whether an index
+    # belongs to it
+    if corpus_ids is not None:
+        return {'corpus': 'ids', 'size': os.path.getsize(corpus_ids + '.ids')}
+    return {'corpus': 'text', 'size': os.path.getsize(corpus_path)}
+
+
+class OccurrenceIndex:
+
+    def __init__(self, prefix):
+        # (None for an index built before PREFIX.meta was written)
+        self.meta = None
+        if os.path.exists(prefix + '.meta'):
+            with open(prefix + '.meta', 'r', encoding='utf8') as f:
+                self.meta = json.load(f)
+        with open(prefix + '.words', 'r', encoding='utf-8') as f:
+            self.words = [line.rstrip('\n') for line in f]
+        self.word_ids = {word: i for i, word in enumerate(self.words)}
+        self.postings = memmap_file(prefix + '.postings', POSTING_DTYPE)
+        self.starts = memmap_file(prefix + '.starts', STARTS_DTYPE)
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def occurrences(self, word):
+        i = self.word_ids[word]
+        return self.postings[int(self.starts[i]):int(self.starts[i + 1])]
+
+
+def read_lines(occurrences, corpus_file=None, corpus=None):
+    # reads the lines of the given occurrences by random access, either from a text corpus (as lists of
+    # wordpieces) or from a binary corpus (as read-only views of the memory-mapped token ids, without copying)
+    last_line_no, line = None, None
+    for occurrence in occurrences:
+        line_no = int(occurrence['line'])
+        if line_no != last_line_no:
+            if corpus is not None:
+                line = corpus[line_no]
+            else:
+                corpus_file.seek(int(occurrence['offset']))
+                line = corpus_file.readline().decode('utf-8').strip().split()
+            last_line_no = line_no
+        yield line
+
+
+def sample_occurrences(index, words, count, rng):
+    # draws count occurrences (or all, if there are fewer) of each word uniformly without replacement;
+    # returns the words and their chosen occurrences in corpus order
+    chosen, word_ids = [], []
+    for i, word in enumerate(words):
+        occurrences = index.occurrences(word)
+        picks = sorted(rng.sample(range(len(occurrences)), min(count, len(occurrences))))
+        chosen.append(occurrences[np.array(picks, dtype=np.int64)])
+        word_ids.append(np.full(len(picks), i, dtype=np.int64))
+    if len(chosen) == 0:
+        return [], np.empty(0, dtype=POSTING_DTYPE)
+
+    chosen, word_ids = np.concatenate(chosen), np.concatenate(word_ids)
+    order = np.lexsort((chosen['index'], chosen['line']))
+    return [words[i] for i in word_ids[order]], chosen[order]
@@ -0,0 +1,156 @@
+import argparse
+import inspect
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from transformers import AutoConfig, BertTokenizer
+
+from bert_model import MODEL_NAME, torch_version
+
+OUTPUT_PREFIX = 'hidden_state_'
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('the ONNX backend requires the onnxruntime package (pip install onnxruntime)')
+    return onnxruntime
+
+
+class _HiddenStates(torch.nn.Module):
+    # the given hidden states of a model, as a tuple of (batch x sequence x hidden size) tensors
+
+    def __init__(self, model, layers):
+        super().__init__()
+        self.model = model
+        self.layers = list(layers)
+
+    def forward(self, input_ids, attention_mask):
+        hidden_states = self.model(input_ids, attention_mask=attention_mask, output_hidden_states=True)[2]
+        return tuple(hidden_states[l] for l in self.layers)
+
+
+def onnx_opset():
+    # The highest ONNX opset that the exporter of the installed torch supports, up to 14: 12 on torch 1.7 (as pinned
+    # in requirements.txt), and 14 from torch 1.11 on (newer transformers need it for their attention).
+    version = torch_version()
+    return 14 if version >= (1, 11) else 13 if version >= (1, 8) else 12
+
+
+def export_onnx(model, path, layers, opset_version=None):
+    # Exports the model (on the CPU) to an ONNX graph that outputs only the given hidden states, named
+    # hidden_state_<layer>, with dynamic batch and sequence axes.
+    opset_version = onnx_opset() if opset_version is None else opset_version
+    input_ids = torch.ones((2, 8), dtype=torch.int64)
+    attention_mask = torch.ones((2, 8), dtype=torch.int32)
+    output_names = [OUTPUT_PREFIX + str(l) for l in layers]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ['input_ids', 'attention_mask'] + output_names}
+    # (newer versions of torch default to the dynamo-based exporter)
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(_HiddenStates(model, layers), (input_ids, attention_mask), path,
+                          input_names=['input_ids', 'attention_mask'], output_names=output_names,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, do_constant_folding=True, **kwargs)
+
+
+class OnnxEncoder:
+    # Runs an exported graph (cf. export_onnx) with ONNX Runtime's CPU execution provider, as a drop-in for the
+    # model in forward_encoded.
+
+    def __init__(self, path, config, threads=None):
+        onnxruntime = _onnxruntime()
+        self.config = config
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads if threads is not None else torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.layers = [int(output.name[len(OUTPUT_PREFIX):]) for output in self.session.get_outputs()]
+
+    def hidden_states(self, input_ids, attention_mask, layers=None):
+        layers = self.layers if layers is None else layers
+        missing = [l for l in layers if l not in self.layers]
+        if len(missing) > 0:
+            raise ValueError(f"the ONNX graph does not output the hidden states {missing}; export it again")
+        outputs = self.session.run([OUTPUT_PREFIX + str(l) for l in layers],
+                                   {'input_ids': input_ids.cpu().numpy().astype(np.int64),
+                                    'attention_mask': attention_mask.cpu().numpy().astype(np.int32)})
+        return [torch.from_numpy(output) for output in outputs]
+
+
+def ensure_onnx(path, layers):
+    # exports the model to path if there is no ONNX graph yet (to a temporary file first, so that path never holds a
+    # partial graph)
+    if not os.path.exists(path):
+        from embedder import load_model
+        print(f"exporting the model to {path}", file=sys.stderr, flush=True)
+        export_onnx(load_model('cpu', num_layers=max(layers)), path + '.tmp', layers)
+        os.replace(path + '.tmp', path)
+
+
+def load_onnx_encoder(path, layers, threads=None, model_name=MODEL_NAME):
+    # loads the ONNX graph at path, exporting the model first if there is none
+    ensure_onnx(path, layers)
+    return OnnxEncoder(path, AutoConfig.from_pretrained(model_name), threads=threads)
+
+
+if __name__ == '__main__':
+    from context_reader import ContextReader
+    from embedder import AllSet, WindowBatches, forward_encoded, load_model, required_layers, word_windows
+
+    parser = argparse.ArgumentParser(
+        description='Exports the model to ONNX (if needed), and checks the ONNX Runtime backend against eager '
+                    'PyTorch on the CPU: the largest deviation of the hidden states, and the speed of both')
+    parser.add_argument('--onnx', type=str, required=True, help='Path of the ONNX graph')
+    parser.add_argument('--contexts', required=True, type=argparse.FileType('rb'),
+                        help='Contexts, as generated from contexts.py')
+    parser.add_argument('--vectorizations', type=str, default='all',
+                        help='Comma-separated list of vectorizations whose hidden states are needed, or \'all\'')
+    parser.add_argument('--count', type=int, default=512, help='Number of contexts to check on')
+    parser.add_argument('--threads', type=int, help='Number of intra-op threads')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each backend')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+    if torch_version() < (1, 7):
+        parser.error(f"the ONNX export requires torch >= 1.7 (installed: {torch.__version__})")
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.set_grad_enabled(False)
+    vectorizations = AllSet() if args.vectorizations == 'all' else args.vectorizations.split(',')
+    try:
+        layers = required_layers(vectorizations, AutoConfig.from_pretrained(MODEL_NAME).num_hidden_layers + 1)
+    except ValueError as e:
+        parser.error(str(e))
+
+    tokenizer = BertTokenizer.from_pretrained(MODEL_NAME)
+    tokenizer.do_basic_tokenize = False
+    window = next(word_windows(ContextReader(args.contexts).groups(), args.count))
+    batches = WindowBatches(window, tokenizer).batches
+
+    backends = {'torch': load_model('cpu', num_layers=max(layers)),
+                'onnx': load_onnx_encoder(args.onnx, layers, threads=args.threads)}
+    num_inputs = sum(len(input_ids) for input_ids, _, _, _, _ in batches)
+    outputs, seconds = dict(), dict()
+    for name, model in backends.items():
+        # (the first, untimed run warms up)
+        outputs[name] = [forward_encoded(input_ids, attention_mask, model, device='cpu', layers=layers)
+                         for input_ids, attention_mask, _, _, _ in batches]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for input_ids, attention_mask, _, _, _ in batches:
+                forward_encoded(input_ids, attention_mask, model, device='cpu', layers=layers)
+        seconds[name] = (time.perf_counter() - start) / args.repeat
+        print(f"{name}: {seconds[name]:.3f}s for {num_inputs} inputs", file=sys.stderr)
+
+    # parity of the hidden states of all non-padding tokens, in the permuted (batch x sequence x layers x hidden)
+    # layout
+    deviation = max(float((reference - output)[attention_mask.bool()].abs().max())
+                    for reference, output, (_, attention_mask, _, _, _) in zip(outputs['torch'], outputs['onnx'],
+                                                                               batches))
+    print(f"max abs deviation of the hidden states {deviation:.3g}; speedup {seconds['torch'] / seconds['onnx']:.2f}x",
+          file=sys.stderr)
@@ -0,0 +1,80 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def background_iter(iterable, queue_size=2):
+    # Iterates over the given iterable in a background thread, which keeps up to queue_size items ready.
+    # Exceptions raised by the iterable are re-raised in the consuming thread.
+    items = queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # the consumer stopped early (or failed): let the producer finish
+        stop.set()
+        thread.join()
+
+
+class BackgroundWorker:
+    # Calls a function on all submitted items in a background thread, fed through a bounded queue. An
+    # exception raised by the function is re-raised on the next submit or on close.
+
+    def __init__(self, function, queue_size=64):
+        self.function = function
+        self._items = queue.Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            item = self._items.get()
+            if item is _DONE:
+                break
+            if self._error is None:
+                try:
+                    self.function(*item)
+                except BaseException as e:
+                    # keep consuming, so that submit does not block on a full queue
+                    self._error = e
+
+    def submit(self, *args):
+        if self._error is not None:
+            raise self._error
+        self._items.put(args)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._items.put(_DONE)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
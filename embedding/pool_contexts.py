@@ -0,0 +1,62 @@
+import argparse
+import sys
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from context_store import ContextStore
+from embedder import AllSet, generate_type_embeddings, required_layers
+from embedding_output import ContainerWriter, Word2VecWriter
+from pipeline import BackgroundWorker, background_iter
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generates type embeddings from the context embeddings kept by embedder.py with --store-contexts, '
+                    'without running the model again')
+    parser.add_argument('--store', type=str, required=True, help='File prefix of the context store')
+    parser.add_argument('--output-prefix', dest='output_prefix', required=True, type=str,
+                        help='File prefix for embedding output files')
+    parser.add_argument('--output-format', dest='output_format', choices=['word2vec', 'container'],
+                        default='word2vec', help='Output format, as for embedder.py')
+    parser.add_argument('--vectorizations', type=str,
+                        help='Comma-separated list of vectorizations to perform, or \'all\'', default='all')
+    parser.add_argument('--poolings', type=str, help='Comma-separated list of poolings to perform, or \'all\'',
+                        default='all')
+    parser.add_argument('--aggregations', type=str, help='Comma-separated list of aggregations to perform, or \'all\'',
+                        default='all')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='Device to pool and aggregate on; defaults to cuda if available')
+    parser.add_argument('--memory-budget', dest='memory_budget', type=int, default=1024,
+                        help='Memory (in MiB) for intermediate results shared between the embedding variants of a word')
+    parser.add_argument('--prefetch', type=int, default=16, help='Number of words to read ahead from the store')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+
+    vectorizations = AllSet() if args.vectorizations == 'all' else args.vectorizations.split(',')
+    poolings = AllSet() if args.poolings == 'all' else args.poolings.split(',')
+    aggregations = AllSet() if args.aggregations == 'all' else args.aggregations.split(',')
+
+    store = ContextStore(args.store)
+    try:
+        required_layers(vectorizations, max(store.layers) + 1)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.output_format == 'container':
+        output = ContainerWriter(args.output_prefix + 'embeddings.emb', store.words)
+    else:
+        output = Word2VecWriter(args.output_prefix)
+    writer = BackgroundWorker(output.write_words)
+
+    # reading (and converting) the stored arrays happens in a background thread
+    stored_words = background_iter(((word, torch.from_numpy(np.asarray(store[word], dtype=np.float32)))
+                                    for word in store.words), queue_size=args.prefetch)
+    for focus_word, context_embeddings in tqdm(stored_words, total=len(store)):
+        type_embeddings = generate_type_embeddings(context_embeddings.to(args.device), vectorizations=vectorizations,
+                                                   poolings=poolings, aggregations=aggregations, layers=store.layers,
+                                                   memory_budget=args.memory_budget << 20)
+        writer.submit([(focus_word, [(embedding_name, type_vector.cpu().numpy())
+                                     for embedding_name, type_vector in type_embeddings])])
+
+    writer.close()
+    output.finalize()
@@ -0,0 +1,44 @@
+import heapq
+import os
+
+
+def line_aligned_ranges(path, num_shards):
+    # splits the file into num_shards contiguous byte ranges (start, end), such that every range
+    # starts at the beginning of a line and ends right after a newline (or at the end of the file).
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, num_shards):
+            pos = max(size * i // num_shards, boundaries[-1])
+            if pos > 0:
+                # skip the remainder of the line we landed in
+                f.seek(pos - 1)
+                f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def range_line_iter(f, start, end):
+    # yields the raw lines of file f whose first byte lies within [start, end)
+    f.seek(start)
+    pos = start
+    while pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def balanced_partition(weights, num_parts):
+    # assigns items to num_parts parts of about equal total weight (greedily, heaviest items first), and
+    # returns the sorted item indices of every part
+    loads = [(0, part) for part in range(num_parts)]
+    parts = [[] for _ in range(num_parts)]
+    for i in sorted(range(len(weights)), key=lambda i: (-weights[i], i)):
+        load, part = heapq.heappop(loads)
+        parts[part].append(i)
+        heapq.heappush(loads, (load + weights[i], part))
+    return [sorted(part) for part in parts]
@@ -0,0 +1,135 @@
+import unittest
+
+import numpy as np
+from scipy.spatial.distance import cosine
+from scipy.stats import spearmanr
+
+from evaluation import cosine_distances, eval_men, eval_toefl
+
+
+# the evaluators as they were before they were batched: scipy's cosine per pair, and argmin per prompt
+def reference_men(embedding, men_pairs):
+    left, right, scores = zip(*men_pairs)
+    scores = -np.array(scores).astype(float)
+    return spearmanr(scores, [cosine(*pair) for pair in zip(embedding[left], embedding[right])])[0]
+
+
+def reference_toefl(embedding, toefl_prompts):
+    toefl_prompts = np.array(toefl_prompts)
+    vectors = embedding[toefl_prompts.reshape(-1)].reshape(*toefl_prompts.shape, -1)
+    return np.array(
+        [np.array([cosine(prompt[0], prompt[i]) for i in range(1, 5)]).argmin() == 0 for prompt in vectors]).mean()
+
+
+class ArrayEmbedding:
+    # the lookup of gensim's KeyedVectors: a word, or a sequence of words
+
+    def __init__(self, words, vectors):
+        self.index = {word: i for i, word in enumerate(words)}
+        self.vectors = vectors
+
+    def __getitem__(self, words):
+        if isinstance(words, str):
+            return self.vectors[self.index[words]]
+        return self.vectors[[self.index[word] for word in words]]
+
+
+def random_embedding(rng, num_words=200, dim=64, dtype=np.float64, special=True):
+    words = [f"w{i}" for i in range(num_words)]
+    vectors = rng.normal(size=(num_words, dim)).astype(dtype)
+    if special:
+        vectors[0] = 0
+        # w1, w2 and w3 are collinear (w3 identical to w2)
+        vectors[2] = vectors[1] * 3
+        vectors[3] = vectors[2]
+    return words, ArrayEmbedding(words, vectors)
+
+
+def random_pairs(rng, words, num_pairs=300):
+    # distinct unordered pairs, so that no two distances tie
+    indices = rng.choice(np.arange(4, len(words)), (2 * num_pairs, 2))
+    indices = np.unique(np.sort(indices[indices[:, 0] != indices[:, 1]], axis=1), axis=0)[:num_pairs]
+    return [(words[a], words[b], float(score)) for (a, b), score in zip(indices, rng.integers(0, 50, num_pairs))]
+
+
+def tied_pairs():
+    # self-pairs and collinear pairs, all at distance 0
+    return [('w5', 'w5', 7.0), ('w6', 'w6', 3.0), ('w1', 'w2', 5.0), ('w2', 'w3', 1.0)]
+
+
+def random_prompts(rng, words, num_prompts=300):
+    return [tuple(words[i] for i in rng.choice(np.arange(4, len(words)), 5, replace=False))
+            for _ in range(num_prompts)]
+
+
+def tied_prompts():
+    # prompts with collinear candidates, or the prompt word among the candidates
+    return [('w7', 'w1', 'w2', 'w3', 'w8'), ('w1', 'w9', 'w2', 'w3', 'w10'), ('w4', 'w11', 'w4', 'w12', 'w13')]
+
+
+class CosineDistancesTest(unittest.TestCase):
+
+    def test_matches_scipy(self):
+        rng = np.random.default_rng(0)
+        words, embedding = random_embedding(rng)
+        pairs = [(a, b) for a, b, _ in random_pairs(rng, words) + tied_pairs()] + [('w0', 'w1'), ('w0', 'w0')]
+        left, right = zip(*pairs)
+        expected = np.array([cosine(u, v) for u, v in zip(embedding[left], embedding[right])])
+        actual = cosine_distances(embedding[left], embedding[right])
+        np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+        np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-12)
+
+    def test_broadcasts_over_prompts(self):
+        rng = np.random.default_rng(1)
+        vectors = rng.normal(size=(10, 5, 16))
+        expected = np.array([[cosine(prompt[0], prompt[i]) for i in range(1, 5)] for prompt in vectors])
+        np.testing.assert_allclose(cosine_distances(vectors[:, :1], vectors[:, 1:]), expected, rtol=0, atol=1e-12)
+
+
+class BatchedEvaluatorsTest(unittest.TestCase):
+    # The batched evaluators compute in float64 and may differ from scipy in the last bits of a distance (and the
+    # loop computed float32 vectors in float32). This only matters where distances tie: self-pairs, collinear vectors,
+    # or the prompt word among its candidates. Such ties may be ranked or broken differently; that is accepted, and
+    # moves the MEN correlation by less than 1e-3 and the TOEFL accuracy by at most one tied prompt. Without ties,
+    # the scores are the same.
+
+    def assert_scores_match(self, embedding, pairs, prompts, places):
+        self.assertAlmostEqual(eval_men(embedding, pairs), reference_men(embedding, pairs), places=places)
+        self.assertEqual(eval_toefl(embedding, prompts), reference_toefl(embedding, prompts))
+
+    def test_float64_scores_match(self):
+        for seed in range(5):
+            rng = np.random.default_rng(seed)
+            words, embedding = random_embedding(rng)
+            self.assert_scores_match(embedding, random_pairs(rng, words), random_prompts(rng, words), places=12)
+
+    def test_float32_scores_match(self):
+        for seed in range(5):
+            rng = np.random.default_rng(seed)
+            words, embedding = random_embedding(rng, dim=768, dtype=np.float32)
+            self.assert_scores_match(embedding, random_pairs(rng, words), random_prompts(rng, words), places=12)
+
+    def test_ties(self):
+        for dtype in (np.float64, np.float32):
+            for seed in range(5):
+                rng = np.random.default_rng(seed)
+                words, embedding = random_embedding(rng, dtype=dtype)
+                pairs = random_pairs(rng, words) + tied_pairs()
+                prompts = random_prompts(rng, words) + tied_prompts()
+                self.assertLess(abs(eval_men(embedding, pairs) - reference_men(embedding, pairs)), 1e-3)
+                self.assertLessEqual(abs(eval_toefl(embedding, prompts) - reference_toefl(embedding, prompts)),
+                                     1 / len(prompts) + 1e-12)
+
+    def test_zero_vectors(self):
+        rng = np.random.default_rng(2)
+        words, embedding = random_embedding(rng)
+        pairs = random_pairs(rng, words) + [('w0', 'w8', 4.0)]
+        self.assertTrue(np.isnan(eval_men(embedding, pairs)))
+        self.assertTrue(np.isnan(reference_men(embedding, pairs)))
+        # a zero candidate has a nan distance, which argmin picks first in both
+        prompts = random_prompts(rng, words) + [('w8', 'w9', 'w0', 'w10', 'w11'), ('w8', 'w0', 'w9', 'w10', 'w11')]
+        self.assertEqual(eval_toefl(embedding, prompts), reference_toefl(embedding, prompts))
+
+
+if __name__ == '__main__':
+    unittest.main()
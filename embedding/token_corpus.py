@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+
+# A processed corpus in binary form consists of two files:
+#   PREFIX.ids      all token ids of all lines, packed as little-endian uint16
+#   PREFIX.offsets  uint64 offsets into PREFIX.ids; line i spans ids[offsets[i]:offsets[i + 1]]
+IDS_DTYPE = np.dtype('<u2')
+OFFSETS_DTYPE = np.dtype('<u8')
+
+
+def memmap_file(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class TokenCorpusWriter:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids_file = open(prefix + '.ids', 'wb')
+        self.offsets_file = open(prefix + '.offsets', 'wb')
+        self.position = 0
+        self.offsets_file.write(np.array([0], dtype=OFFSETS_DTYPE).tobytes())
+
+    def write(self, ids):
+        ids = np.asarray(ids)
+        assert len(ids) == 0 or ids.max() <= np.iinfo(IDS_DTYPE).max
+        self.ids_file.write(ids.astype(IDS_DTYPE).tobytes())
+        self.position += len(ids)
+        self.offsets_file.write(np.array([self.position], dtype=OFFSETS_DTYPE).tobytes())
+
+    def append_corpus(self, prefix):
+        # appends all lines of another binary corpus, e.g. a shard written by a worker process
+        other = TokenCorpus(prefix)
+        self.ids_file.write(np.asarray(other.ids).tobytes())
+        self.offsets_file.write((np.asarray(other.offsets[1:]) + np.uint64(self.position)).astype(OFFSETS_DTYPE)
+                                .tobytes())
+        self.position += len(other.ids)
+        del other
+
+    def close(self):
+        self.ids_file.close()
+        self.offsets_file.close()
+
+
+class TokenCorpus:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = memmap_file(prefix + '.ids', IDS_DTYPE)
+        self.offsets = memmap_file(prefix + '.offsets', OFFSETS_DTYPE)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, line):
+        # returns a read-only view into the memory-mapped id file
+        return self.ids[int(self.offsets[line]):int(self.offsets[line + 1])]
+
+    def lines(self, start=0, end=None):
+        end = len(self) if end is None else end
+        for line in range(start, end):
+            yield self[line]
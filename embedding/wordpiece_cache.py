@@ -0,0 +1,37 @@
+import collections
+
+
+class CachedWordpieceTokenizer:
+    # Memoizes the greedy longest-match wordpiece tokenization of single words in a bounded LRU
+    # cache. Due to the Zipfian word distribution, few distinct words make up most occurrences.
+
+    def __init__(self, wordpiece_tokenizer, maxsize=1_000_000):
+        self.wordpiece_tokenizer = wordpiece_tokenizer
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def tokenize(self, word):
+        pieces = self._cache.get(word)
+        if pieces is not None:
+            self.hits += 1
+            self._cache.move_to_end(word)
+            return pieces
+
+        self.misses += 1
+        pieces = tuple(self.wordpiece_tokenizer.tokenize(word))
+        if self.maxsize > 0:
+            self._cache[word] = pieces
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return pieces
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        return f"wordpiece cache: {self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate), " \
+               f"{len(self._cache)}/{self.maxsize} entries"
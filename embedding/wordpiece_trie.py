@@ -0,0 +1,76 @@
+import numpy as np
+
+
+class WordpieceTrie:
+    # Immutable trie over wordpiece ids, stored in NumPy arrays. The children of the root are looked up
+    # in a dense array over the vocabulary, all other transitions in a sorted array of keys
+    # (node * vocab_size + piece). A word matches if the full piece sequence of a word in a line, i.e. a
+    # word-initial piece followed by all its suffix ('##') pieces, is a path to a node with a value.
+
+    def __init__(self, words, word_piece_ids, suffix_mask):
+        self.words = list(words)
+        self.suffix_mask = np.asarray(suffix_mask, dtype=bool)
+        self.vocab_size = len(self.suffix_mask)
+
+        root_child = {}
+        transitions = {}
+        node_word = [-1]
+        for word_id, piece_ids in enumerate(word_piece_ids):
+            piece_ids = [int(p) for p in piece_ids]
+            if len(piece_ids) == 0:
+                continue
+            children = root_child
+            cur = None
+            for depth, piece in enumerate(piece_ids):
+                key = piece if depth == 0 else cur * self.vocab_size + piece
+                if key not in children:
+                    children[key] = len(node_word)
+                    node_word.append(-1)
+                cur = children[key]
+                children = transitions
+            node_word[cur] = word_id
+
+        self.max_depth = max((len(p) for p in word_piece_ids), default=0)
+        self.node_word = np.array(node_word, dtype=np.int64)
+        self.root_child = np.full(self.vocab_size, -1, dtype=np.int64)
+        if len(root_child) > 0:
+            self.root_child[np.fromiter(root_child.keys(), dtype=np.int64)] = np.fromiter(root_child.values(),
+                                                                                          dtype=np.int64)
+        keys = np.fromiter(transitions.keys(), dtype=np.int64, count=len(transitions))
+        order = np.argsort(keys)
+        self.transition_keys = keys[order]
+        self.transition_targets = np.fromiter(transitions.values(), dtype=np.int64, count=len(transitions))[order]
+
+    def match_lines(self, ids, offsets):
+        # Matches all words in a batch of lines, given as the concatenation of their piece ids and the
+        # line boundaries (line i spans ids[offsets[i]:offsets[i + 1]]). Returns arrays of the line
+        # number (within the batch), word id, focus index (within the line) and focus length of all
+        # matches, ordered by position.
+        ids = np.asarray(ids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        starts = np.flatnonzero(~self.suffix_mask[ids])
+
+        breaks = np.union1d(starts, offsets)
+        ends = breaks[np.searchsorted(breaks, starts, side='right')]
+        lengths = ends - starts
+        lines = np.searchsorted(offsets, starts, side='right') - 1
+
+        state = self.root_child[ids[starts]]
+        state[lengths > self.max_depth] = -1
+        for depth in range(1, self.max_depth):
+            active = np.flatnonzero((lengths > depth) & (state >= 0))
+            if len(active) == 0:
+                break
+            keys = state[active] * self.vocab_size + ids[starts[active] + depth]
+            # (max_depth > 1 implies that there are transitions)
+            pos = np.minimum(np.searchsorted(self.transition_keys, keys), len(self.transition_keys) - 1)
+            state[active] = np.where(self.transition_keys[pos] == keys, self.transition_targets[pos], -1)
+
+        word_ids = np.where(state >= 0, self.node_word[state], -1)
+        matched = np.flatnonzero(word_ids >= 0)
+        return lines[matched], word_ids[matched], starts[matched] - offsets[lines[matched]], lengths[matched]
+
+    def match(self, ids):
+        # matches all words in a single line of piece ids, as (word, focus index, focus length) tuples
+        _, word_ids, indices, lengths = self.match_lines(ids, [0, len(ids)])
+        return [(self.words[w], int(i), int(l)) for w, i, l in zip(word_ids, indices, lengths)]